@@ -0,0 +1,39 @@
+"""
+In-place upgrades for speaker databases created by older versions of schema.sql.
+Shared by the backend and the scripts so every code path migrates a database the same way.
+"""
+import sqlite3
+
+
+def ensure_sources_columns(conn: sqlite3.Connection) -> list[str]:
+    """
+    Adds the sources.embedding_dtype and sources.audio_sha columns to databases created
+    before they existed. Returns the names of the columns that were added.
+    """
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA table_info(sources)")
+    columns = [row[1] for row in cursor.fetchall()]
+    added = []
+    if columns and "embedding_dtype" not in columns:
+        cursor.execute("ALTER TABLE sources ADD COLUMN embedding_dtype TEXT NOT NULL DEFAULT 'float32'")
+        added.append("embedding_dtype")
+    if columns and "audio_sha" not in columns:
+        cursor.execute("ALTER TABLE sources ADD COLUMN audio_sha TEXT")
+        added.append("audio_sha")
+    conn.commit()
+    return added
+
+
+def ensure_embedding_cache_table(conn: sqlite3.Connection):
+    """Creates the embedding_cache table (SHA-256 of enrollment audio -> embedding) if missing."""
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS embedding_cache (
+            sha TEXT PRIMARY KEY,
+            embedding BLOB NOT NULL,
+            embedding_dtype TEXT NOT NULL DEFAULT 'float32'
+        );
+        """
+    )
+    conn.commit()
@@ -11,12 +11,26 @@ CREATE TABLE sources (
     source_url TEXT,
     timestamp TEXT,
     embedding BLOB NOT NULL,
+    -- Embeddings are L2-normalized (unit length) at enrollment; legacy rows may not be,
+    -- so readers normalize after loading.
+    -- NumPy dtype of the embedding BLOB ('float16' for new enrollments, 'float32' for legacy rows)
+    embedding_dtype TEXT NOT NULL DEFAULT 'float32',
+    -- SHA-256 of the enrolled audio file, used to reuse embeddings for identical clips
+    audio_sha TEXT,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (speaker_id) REFERENCES speakers (id)
 );
 
 CREATE INDEX idx_speaker_name ON speakers (name);
 CREATE INDEX idx_source_speaker_id ON sources (speaker_id);
+CREATE INDEX idx_sources_speaker_url_ts ON sources (speaker_id, source_url, timestamp);
+
+-- Cache of enrollment embeddings keyed by the SHA-256 of the audio bytes
+CREATE TABLE IF NOT EXISTS embedding_cache (
+    sha TEXT PRIMARY KEY,
+    embedding BLOB NOT NULL,
+    embedding_dtype TEXT NOT NULL DEFAULT 'float32'
+);
 
 -- Store simple key/value settings (e.g., threshold)
 CREATE TABLE IF NOT EXISTS settings (
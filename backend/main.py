@@ -4,7 +4,6 @@ from fastapi.middleware.cors import CORSMiddleware
 import torch
 import numpy as np
 from pyannote.audio import Inference
-from pyannote.core import SlidingWindowFeature
 import io
 import os
 from pydub import AudioSegment
@@ -15,6 +14,9 @@ import sqlite3
 import csv
 import shutil
 import tempfile
+import hashlib
+
+from backend.databases.migrations import ensure_sources_columns, ensure_embedding_cache_table
 
 # --- Configuration for saving audio ---
 SAVE_ERROR_AUDIO_DIR = "/app/error_audio_dumps"
@@ -76,6 +78,8 @@ speaker_embeddings = {}
 default_similarity_threshold = 0.2
 # Structure: { userId: float threshold }
 user_similarity_thresholds: dict[str, float] = {}
+# NumPy dtype used for newly enrolled embedding BLOBs
+enrollment_embedding_dtype = "float16"
 
 def get_user_threshold(userId: str) -> float:
     try:
@@ -95,6 +99,37 @@ def ensure_settings_table(conn: sqlite3.Connection):
     )
     conn.commit()
 
+def compute_enrollment_embedding(conn: sqlite3.Connection, audio_path: str) -> tuple[bytes, str, str]:
+    """
+    Returns (embedding_blob, embedding_dtype, audio_sha) for an enrollment clip using the resident model.
+    Embeddings are cached by the SHA-256 of the audio bytes, so re-enrolling the same
+    clip is a single lookup instead of a forward pass.
+    """
+    with open(audio_path, "rb") as f:
+        if hasattr(hashlib, "file_digest"):  # Python 3.11+
+            audio_sha = hashlib.file_digest(f, "sha256").hexdigest()
+        else:
+            audio_sha = hashlib.sha256(f.read()).hexdigest()
+
+    cursor = conn.cursor()
+    cursor.execute("SELECT embedding, embedding_dtype FROM embedding_cache WHERE sha = ?", (audio_sha,))
+    cached = cursor.fetchone()
+    if cached:
+        print(f"Embedding cache hit for {audio_path} ({audio_sha[:12]}).")
+        return cached[0], cached[1], audio_sha
+
+    embedding_output = inference_model(audio_path)
+    # window="whole" always yields a single (D,) / (1, D) embedding
+    embedding_np = np.asarray(embedding_output).squeeze()
+    # Store the unit vector so matching is a plain dot product
+    embedding_np = embedding_np / (np.linalg.norm(embedding_np) + 1e-12)
+    embedding_blob = embedding_np.astype(enrollment_embedding_dtype).tobytes()
+    cursor.execute(
+        "INSERT OR REPLACE INTO embedding_cache(sha, embedding, embedding_dtype) VALUES(?, ?, ?)",
+        (audio_sha, embedding_blob, enrollment_embedding_dtype)
+    )
+    return embedding_blob, enrollment_embedding_dtype, audio_sha
+
 def get_threshold_from_db(db_path: str) -> float:
     try:
         conn = sqlite3.connect(db_path)
@@ -164,12 +199,22 @@ def initialize_db(db_path: str):
                 source_url TEXT,
                 timestamp TEXT,
                 embedding BLOB NOT NULL,
+                embedding_dtype TEXT NOT NULL DEFAULT 'float32',
+                audio_sha TEXT,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (speaker_id) REFERENCES speakers (id)
             );
             """)
             cursor.execute("CREATE INDEX idx_speaker_name ON speakers (name);")
             cursor.execute("CREATE INDEX idx_source_speaker_id ON sources (speaker_id);")
+            cursor.execute("CREATE INDEX idx_sources_speaker_url_ts ON sources (speaker_id, source_url, timestamp);")
+            cursor.execute("""
+            CREATE TABLE embedding_cache (
+                sha TEXT PRIMARY KEY,
+                embedding BLOB NOT NULL,
+                embedding_dtype TEXT NOT NULL DEFAULT 'float32'
+            );
+            """)
         conn.commit()
     except sqlite3.Error as e:
         print(f"Failed to initialize database {db_path}: {e}")
@@ -191,20 +236,26 @@ def load_embeddings_for_user(userId: str):
 
     try:
         conn = sqlite3.connect(db_path)
+        ensure_sources_columns(conn)
         cursor = conn.cursor()
         cursor.execute("""
-            SELECT s.name, src.embedding
+            SELECT s.name, src.embedding, src.embedding_dtype
             FROM speakers s
             JOIN sources src ON s.id = src.speaker_id
         """)
         rows = cursor.fetchall()
         
-        for speaker_name, embedding_blob in rows:
+        for speaker_name, embedding_blob, embedding_dtype in rows:
             try:
-                embedding_npy = np.frombuffer(embedding_blob, dtype=np.float32)
+                if embedding_dtype not in ("float32", "float16"):
+                    raise ValueError(f"Unsupported embedding dtype '{embedding_dtype}'.")
+                embedding_npy = np.frombuffer(embedding_blob, dtype=embedding_dtype).astype(np.float32)
                 embedding_tensor = torch.from_numpy(embedding_npy).to(device)
                 if embedding_tensor.dim() == 1:
                     embedding_tensor = embedding_tensor.unsqueeze(0)
+                # Legacy rows are raw pyannote outputs; unit-normalize every row so no single
+                # enrollment outweighs the others in the speaker's average
+                embedding_tensor = torch.nn.functional.normalize(embedding_tensor, p=2, dim=-1)
                 
                 if speaker_name in user_specific_embeddings:
                     existing = user_specific_embeddings[speaker_name]
@@ -221,6 +272,11 @@ def load_embeddings_for_user(userId: str):
         if 'conn' in locals() and conn:
             conn.close()
 
+    # Averaging unit vectors shortens them; renormalize so cosine similarity at match time
+    # is a single matrix-vector product
+    for speaker_name, embedding_tensor in user_specific_embeddings.items():
+        user_specific_embeddings[speaker_name] = torch.nn.functional.normalize(embedding_tensor, p=2, dim=-1)
+
     speaker_embeddings[userId] = user_specific_embeddings
     if not user_specific_embeddings:
         print(f"No speaker embeddings found for user {userId}.")
@@ -282,6 +338,8 @@ async def enroll_speaker(payload: dict = Body(...)):
 
     if not userId or not speaker_name or not youtube_url:
         return {"status": "error", "message": "Missing userId, speaker name, or YouTube URL."}
+    if inference_model is None:
+        return {"status": "error", "message": "Speaker embedding model is not loaded."}
 
     db_path = get_db_path(userId)
     initialize_db(db_path)
@@ -304,19 +362,31 @@ async def enroll_speaker(payload: dict = Body(...)):
         subprocess.run(command, check=True, capture_output=True, text=True)
         print("Download complete.")
 
+        # Enroll in-process with the resident model instead of spawning enroll_speaker.py,
+        # which would reload the model on every request
         print(f"Enrolling speaker {speaker_name} from {downloaded_audio_path} (user {userId})...")
-        enroll_command = [
-            "python3", "/app/scripts/enroll_speaker.py",
-            "-n", speaker_name,
-            "-i", downloaded_audio_path,
-            "--url", youtube_url,
-            "--db-path", db_path # Pass user-specific DB path
-        ]
-        if timestamp:
-            enroll_command.extend(["--timestamp", timestamp])
-        
-        subprocess.run(enroll_command, check=True, capture_output=True, text=True)
-        print("Enrollment script finished.")
+        conn = sqlite3.connect(db_path)
+        try:
+            ensure_sources_columns(conn)
+            ensure_embedding_cache_table(conn)
+            embedding_blob, embedding_dtype, audio_sha = compute_enrollment_embedding(conn, downloaded_audio_path)
+
+            cursor = conn.cursor()
+            cursor.execute("SELECT id FROM speakers WHERE name = ?", (speaker_name,))
+            speaker_row = cursor.fetchone()
+            if speaker_row:
+                speaker_id = speaker_row[0]
+            else:
+                cursor.execute("INSERT INTO speakers (name) VALUES (?)", (speaker_name,))
+                speaker_id = cursor.lastrowid
+            cursor.execute(
+                "INSERT INTO sources (speaker_id, source_url, timestamp, embedding, embedding_dtype, audio_sha) VALUES (?, ?, ?, ?, ?, ?)",
+                (speaker_id, youtube_url, timestamp, embedding_blob, embedding_dtype, audio_sha)
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        print("Enrollment finished.")
 
         load_embeddings_for_user(userId)
         return {"status": "success", "message": f"Speaker {speaker_name} enrolled successfully."}
@@ -336,26 +406,27 @@ def is_target_speaker(audio_data: bytes, userId: str) -> tuple[bool, float]:
     unique_id = str(uuid.uuid4())[:8]
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     log_prefix = f"[{timestamp}-{unique_id}]"
-    saved_success_path = None
     max_similarity_score = 0.0
 
     try:
         audio_segment = AudioSegment.from_file(io.BytesIO(audio_data), format="webm")
-        audio_segment = audio_segment.set_frame_rate(16000).set_channels(1)
-        
-        saved_success_filename = f"live_audio_{timestamp}_{unique_id}.wav"
-        saved_success_path = os.path.join(SAVE_SUCCESS_AUDIO_DIR, saved_success_filename)
-        audio_segment.export(saved_success_path, format="wav")
-
-        live_audio_embedding_output = inference_model(saved_success_path)
-        live_embedding_np = live_audio_embedding_output.data.mean(axis=0) if isinstance(live_audio_embedding_output, SlidingWindowFeature) else np.asarray(live_audio_embedding_output)
-        live_audio_embedding = torch.from_numpy(live_embedding_np).to(device).unsqueeze(0)
+        audio_segment = audio_segment.set_frame_rate(16000).set_channels(1).set_sample_width(2)
+
+        # Hand the decoded samples to pyannote directly instead of writing a WAV and reading it back
+        samples = np.frombuffer(audio_segment.raw_data, dtype=np.int16).astype(np.float32) / 32768.0
+        waveform = torch.from_numpy(samples).unsqueeze(0)
+        live_audio_embedding_output = inference_model({"waveform": waveform, "sample_rate": 16000})
+        live_embedding_np = np.asarray(live_audio_embedding_output).squeeze()
+        live_audio_embedding = torch.nn.functional.normalize(torch.from_numpy(live_embedding_np).to(device).view(1, -1), p=2, dim=-1)
+
+        # Enrolled embeddings are unit vectors, so one (K, D) @ (D, 1) product scores every speaker
+        speaker_names = list(user_embeddings.keys())
+        enrolled_matrix = torch.cat([user_embeddings[name] for name in speaker_names], dim=0)
+        similarity_scores = (enrolled_matrix @ live_audio_embedding.t()).squeeze(-1).tolist()
         
         # Read current threshold for this user on each inference so updates take effect immediately
         threshold = get_user_threshold(userId)
-        for speaker_name, enrolled_embedding in user_embeddings.items():
-            similarity = torch.nn.functional.cosine_similarity(live_audio_embedding, enrolled_embedding)
-            similarity_score = similarity.item()
+        for speaker_name, similarity_score in zip(speaker_names, similarity_scores):
             max_similarity_score = max(max_similarity_score, similarity_score)
             
             if similarity_score > threshold:
@@ -368,9 +439,6 @@ def is_target_speaker(audio_data: bytes, userId: str) -> tuple[bool, float]:
         print(f"ERROR {log_prefix}: Speaker detection failed for user {userId}: {e}")
         # Save problematic audio for debugging
         return False, 0.0
-    finally:
-        if saved_success_path and os.path.exists(saved_success_path):
-            os.remove(saved_success_path)
 
 @app.get("/threshold")
 async def get_threshold(userId: str = Query(...)):
@@ -9,9 +9,20 @@ from tqdm import tqdm
 import shutil
 import tempfile
 import uuid
-from concurrent.futures import ProcessPoolExecutor, as_completed
-import multiprocessing
+import wave
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import traceback
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from _embedding_batch import submit_bounded
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+    print("WARNING: numba not installed. Falling back to NumPy for PCM sample conversion.")
 
 # --- Configuration ---
 HF_TOKEN = os.getenv("HF_AUTH_TOKEN")
@@ -33,18 +44,56 @@ SAMPLE_RATE = 16000
 MIN_VAD_SEGMENT_DURATION_S = 1.0 # Minimum duration for a VAD segment to be considered for embedding
 INITIAL_CONFIDENCE_THRESHOLD = 0.5  # Start with a lower threshold
 CONFIDENCE_THRESHOLD_INCREMENT = 0.2 # Increase by this much each round
-
-# Global variable for models within multiprocessing context (each process loads its own)
+EMBEDDING_BATCH_SIZE = 32 # Number of clips or speech segments per forward pass of the embedding model
+DECODE_WORKERS = 4 # Threads decoding clips ahead of the embedding model
+COARSE_SIMILARITY_MARGIN = 0.25 # Skip a file when its coarse speech similarity is below the threshold by more than this
+COARSE_MAX_SECONDS = 120 # Length cap of the speech subsample embedded for the coarse admission check
+COARSE_WINDOW_SECONDS = 1 # Longer speech is subsampled as windows of this length spread evenly across it
+COARSE_MIN_SECONDS = 5 # Files with less speech than this skip the coarse check and score every segment
+
+# Global model instances. They are loaded once, in the main process, and shared by all
+# decode threads so only a single copy of each model lives on the GPU.
 _embedding_model_instance = None
 _vad_pipeline_instance = None
 _device_instance = None
+# Serializes calls into the shared VAD pipeline from the decode threads
+_vad_lock = threading.Lock()
 
 # --- Helper Functions ---
 
-def _init_worker_models():
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _decode_s16_to_f32(buf, out, scale):
+        """Converts 16-bit PCM samples to scaled float32 in a single fused pass."""
+        for i in prange(buf.shape[0]):
+            out[i] = buf[i] * scale
+else:
+    def _decode_s16_to_f32(buf, out, scale):
+        """Converts 16-bit PCM samples to scaled float32 in a single pass."""
+        np.multiply(buf, scale, out=out)
+
+def _segment_to_pcm(audio):
+    """Returns a zero-copy int16 view of the raw PCM bytes of a 16-bit mono AudioSegment."""
+    return np.frombuffer(audio.raw_data, dtype=np.int16)
+
+def _pcm_to_waveform(pcm):
+    """Converts 16-bit PCM samples to a normalized float32 waveform in a preallocated buffer."""
+    waveform = np.empty(pcm.shape[0], dtype=np.float32)
+    _decode_s16_to_f32(pcm, waveform, np.float32(1.0 / 32768))
+    return waveform
+
+def _write_wav(path, pcm):
+    """Writes 16-bit mono PCM samples at SAMPLE_RATE to a WAV file."""
+    with wave.open(path, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(SAMPLE_RATE)
+        wav_file.writeframes(pcm.tobytes())
+
+def _init_models():
     """
-    Initializes the pyannote embedding and VAD models/pipelines in each worker process.
-    Called once per process in the ProcessPoolExecutor.
+    Initializes the pyannote embedding and VAD models/pipelines.
+    Called once in the main process; the decode threads share these instances.
     """
     global _embedding_model_instance, _vad_pipeline_instance, _device_instance
     if _embedding_model_instance is None or _vad_pipeline_instance is None:
@@ -68,9 +117,9 @@ def _init_worker_models():
             # Ensure the VAD pipeline also uses the specified device
             _vad_pipeline_instance.to(_device_instance)
 
-            print(f"Worker models (embedding, VAD pipeline) loaded successfully on device: {_device_instance}")
+            print(f"Models (embedding, VAD pipeline) loaded successfully on device: {_device_instance}")
         except Exception as e:
-            print(f"CRITICAL: Worker failed to load pyannote models: {e}")
+            print(f"CRITICAL: Failed to load pyannote models: {e}")
             traceback.print_exc() # Print full traceback for critical errors
             raise
 
@@ -82,9 +131,9 @@ def get_embedding(audio_input):
     """
     global _embedding_model_instance, _device_instance
     if _embedding_model_instance is None:
-        # This branch should ideally not be hit if _init_worker_models is called
+        # This branch should ideally not be hit if _init_models is called
         # but as a safeguard, it ensures models are loaded.
-        _init_worker_models() 
+        _init_models() 
 
     try:
         if isinstance(audio_input, str): # Path to a file
@@ -107,101 +156,222 @@ def get_embedding(audio_input):
         return None
 
 
+def _load_waveform(filepath):
+    """Decodes an audio file to a mono float32 numpy waveform at SAMPLE_RATE. Returns None on failure."""
+    try:
+        audio = AudioSegment.from_file(filepath).set_channels(1).set_frame_rate(SAMPLE_RATE).set_sample_width(2)
+        return _pcm_to_waveform(_segment_to_pcm(audio))
+    except Exception as e:
+        tqdm.write(f"Warning: Could not decode {filepath}. Error: {e}")
+        return None
+
+def _embed_waveform_batch(waveforms):
+    """
+    Runs a single forward pass of the embedding model over a list of mono numpy waveforms.
+    Shorter clips are zero-padded; the padded tail is masked out of the statistics pooling
+    so each row matches the embedding of the unpadded clip.
+    Returns a (B, D) tensor on the model device.
+    """
+    model = _embedding_model_instance.model
+    max_samples = max(len(w) for w in waveforms)
+    max_frames = model.num_frames(max_samples)
+
+    batch = torch.zeros((len(waveforms), 1, max_samples), dtype=torch.float32)
+    weights = torch.zeros((len(waveforms), max_frames), dtype=torch.float32)
+    for i, waveform in enumerate(waveforms):
+        batch[i, 0, :len(waveform)] = torch.from_numpy(waveform)
+        weights[i, :model.num_frames(len(waveform))] = 1.0
+
+    with torch.inference_mode():
+        return model(batch.to(_device_instance), weights=weights.to(_device_instance))
+
 def get_embedding_from_folder(folder_path):
-    """Generates a single, averaged embedding from a folder of audio files."""
-    all_embeddings = []
-    audio_files = [f for f in os.listdir(folder_path) if f.lower().endswith(('.wav', '.mp3'))]
+    """
+    Generates a single, averaged embedding from a folder of audio files.
+    Clips are decoded by a thread pool while the main thread runs batched
+    forward passes of EMBEDDING_BATCH_SIZE clips on the model device.
+    """
+    audio_files = [os.path.join(folder_path, f) for f in os.listdir(folder_path) if f.lower().endswith(('.wav', '.mp3'))]
 
     if not audio_files:
         return None
 
     global _embedding_model_instance, _device_instance
     if _embedding_model_instance is None:
-        _init_worker_models() # Initialize all models
+        _init_models() # Initialize all models
+
+    # Group clips of similar length into the same batch to keep padding small
+    audio_files.sort(key=os.path.getsize)
 
-    for filename in tqdm(audio_files, desc=f"Generating master embedding from {os.path.basename(folder_path)}"):
-        filepath = os.path.join(folder_path, filename)
-        embedding = get_embedding(filepath)
-        if embedding is not None:
-            all_embeddings.append(embedding)
+    embedding_sum = None
+    embedding_count = 0
+    pending = []
 
-    if not all_embeddings:
+    def flush(pending):
+        nonlocal embedding_sum, embedding_count
+        try:
+            batch_embeddings = _embed_waveform_batch(pending)
+        except Exception as e:
+            tqdm.write(f"Warning: Could not generate embeddings for a batch of {len(pending)} clips. Error: {e}")
+            return
+        batch_sum = batch_embeddings.sum(dim=0)
+        embedding_sum = batch_sum if embedding_sum is None else embedding_sum + batch_sum
+        embedding_count += len(pending)
+
+    with ThreadPoolExecutor(max_workers=DECODE_WORKERS) as decoder:
+        waveforms = decoder.map(_load_waveform, audio_files)
+        for waveform in tqdm(waveforms, total=len(audio_files), desc=f"Generating master embedding from {os.path.basename(folder_path)}"):
+            if waveform is None or len(waveform) == 0:
+                continue
+            pending.append(waveform)
+            if len(pending) == EMBEDDING_BATCH_SIZE:
+                flush(pending)
+                pending = []
+        if pending:
+            flush(pending)
+
+    if embedding_count == 0:
         return None
 
-    return np.mean(np.stack(all_embeddings), axis=0)
+    # Single device-to-host copy for the whole folder
+    return (embedding_sum / embedding_count).cpu().numpy()
 
-def process_single_raw_audio_file(raw_file_path, master_embedding_np, current_confidence_threshold, round_output_dir, speaker_name):
+def prepare_raw_audio_file(raw_file_path):
     """
-    Processes a single raw audio file, performs VAD, extracts speech segments,
-    and saves matching speaker clips.
-    This function is designed to be run in parallel by ProcessPoolExecutor.
+    CPU stage: decodes a raw audio file and runs Voice Activity Detection on it.
+    Runs in a decode thread. ffmpeg decoding happens in a subprocess, so threads overlap
+    freely; calls into the shared VAD pipeline are serialized.
+    Returns (pcm, waveform_full, segments_ms, segments_idx), or None on failure.
+    pydub is only used for the initial decode/resample; everything downstream is ndarray-based.
     """
-    global _embedding_model_instance, _vad_pipeline_instance, _device_instance
-    if _embedding_model_instance is None or _vad_pipeline_instance is None:
-        _init_worker_models() # Ensure models are loaded in this process
+    try:
+        audio = AudioSegment.from_file(raw_file_path).set_channels(1).set_frame_rate(SAMPLE_RATE).set_sample_width(2)
 
-    found_clips_in_file = 0
-    master_embedding = torch.from_numpy(master_embedding_np).to(_device_instance).unsqueeze(0)
+        # Decode the whole file to a normalized waveform once; chunks are views into it
+        pcm = _segment_to_pcm(audio)
+        waveform_full = _pcm_to_waveform(pcm)
 
-    try:
-        audio = AudioSegment.from_file(raw_file_path).set_channels(1).set_frame_rate(SAMPLE_RATE)
-        
-        # 1. Perform Voice Activity Detection using the VAD pipeline
-        speech_annotation: Annotation = _vad_pipeline_instance(raw_file_path)
+        # 1. Perform Voice Activity Detection on the in-memory waveform
+        with _vad_lock:
+            speech_annotation: Annotation = _vad_pipeline_instance(
+                {'waveform': torch.from_numpy(waveform_full).unsqueeze(0), 'sample_rate': SAMPLE_RATE}
+            )
 
         # Convert the Annotation to a Timeline, which can then be iterated for coverage
         # This will merge overlapping or contiguous speech segments.
         speech_timeline: Timeline = speech_annotation.get_timeline().support()
 
-        # 2. Iterate through detected speech segments in the timeline
-        for segment in speech_timeline:
-            start_s = segment.start
-            end_s = segment.end
-            
-            # Ensure segment is long enough
-            if (end_s - start_s) < MIN_VAD_SEGMENT_DURATION_S:
-                continue
+        # 2. Filter segments in one vectorized pass instead of branching per Segment
+        segments_s = np.array([(segment.start, segment.end) for segment in speech_timeline], dtype=np.float64).reshape(-1, 2)
+        segments_s = segments_s[(segments_s[:, 1] - segments_s[:, 0]) >= MIN_VAD_SEGMENT_DURATION_S]
+        segments_ms = (segments_s * 1000).astype(np.int64)
+        segments_idx = segments_ms * SAMPLE_RATE // 1000
 
-            # Extract audio chunk based on VAD segment
-            start_ms = int(start_s * 1000)
-            end_ms = int(end_s * 1000)
-            chunk = audio[start_ms:end_ms]
+        # Batch segments of similar length together to keep padding small
+        order = np.argsort(segments_idx[:, 1] - segments_idx[:, 0], kind="stable")
+        return pcm, waveform_full, segments_ms[order], segments_idx[order]
+    except Exception as e:
+        tqdm.write(f"Warning: Failed to decode or run VAD on raw file {raw_file_path}. Error: {e}")
+        traceback.print_exc()
+        return None
 
-            # Convert pydub AudioSegment to numpy array for embedding
-            chunk_samples = np.array(chunk.get_array_of_samples())
-            chunk_waveform_np = chunk_samples / (2**((chunk.sample_width * 8) - 1)) # Normalize
-            
-            chunk_embedding_np = get_embedding((chunk_waveform_np, SAMPLE_RATE))
+def _coarse_admission_waveform(waveform_full, segments_idx):
+    """
+    Builds the clip used for the coarse admission check from the file's speech in time order.
+    Up to COARSE_MAX_SECONDS of speech is used whole; longer speech contributes
+    COARSE_WINDOW_SECONDS windows spaced evenly across it, filling exactly COARSE_MAX_SECONDS,
+    so the forward pass stays small however long the recording is.
+    Returns None when there is less than COARSE_MIN_SECONDS of speech to judge from.
+    """
+    segments_idx = segments_idx[np.argsort(segments_idx[:, 0], kind="stable")]
+    lengths = segments_idx[:, 1] - segments_idx[:, 0]
+    speech_samples = int(lengths.sum())
+    if speech_samples < COARSE_MIN_SECONDS * SAMPLE_RATE:
+        return None
+    budget = COARSE_MAX_SECONDS * SAMPLE_RATE
+    if speech_samples <= budget:
+        return np.concatenate([waveform_full[start_idx:end_idx] for start_idx, end_idx in segments_idx.tolist()])
+
+    # Window starts are offsets into the concatenated speech; each window is cut from the
+    # segment(s) it overlaps, so one crossing a segment boundary continues in the next segment
+    window = COARSE_WINDOW_SECONDS * SAMPLE_RATE
+    num_windows = budget // window
+    window_starts = np.arange(num_windows, dtype=np.int64) * speech_samples // num_windows
+    speech_ends = np.cumsum(lengths)
+    speech_starts = speech_ends - lengths
+    pieces = []
+    for (start_idx, _), seg_start, seg_end in zip(segments_idx.tolist(), speech_starts.tolist(), speech_ends.tolist()):
+        first = np.searchsorted(window_starts + window, seg_start, side="right")
+        last = np.searchsorted(window_starts, seg_end, side="left")
+        for window_start in window_starts[first:last].tolist():
+            lo = max(window_start, seg_start) - seg_start
+            hi = min(window_start + window, seg_end) - seg_start
+            pieces.append(waveform_full[start_idx + lo:start_idx + hi])
+    return np.concatenate(pieces)
+
+def extract_matching_clips(raw_file_path, prepared, master_embedding, current_confidence_threshold, round_output_dir, speaker_name):
+    """
+    GPU stage: embeds the speech segments of a prepared file in batches of
+    EMBEDDING_BATCH_SIZE and saves the clips that match the master embedding.
+    Runs on the main thread, which holds the only embedding model instance.
+    Files whose speech, embedded as one bounded subsample, is already far from the
+    master are skipped with a single forward pass instead of one per segment.
+    """
+    pcm, waveform_full, segments_ms, segments_idx = prepared
+    raw_file_base = os.path.splitext(os.path.basename(raw_file_path))[0]
+    found_clips_in_file = 0
 
-            if chunk_embedding_np is None:
-                continue
+    if len(segments_idx) == 0:
+        return 0
+
+    try:
+        # Admission control: a mixed recording's embedding is roughly a weighted average of its
+        # speakers, so a low coarse similarity means no segment is likely to match either.
+        coarse_waveform = _coarse_admission_waveform(waveform_full, segments_idx)
+        if coarse_waveform is not None:
+            coarse_embedding = _embed_waveform_batch([coarse_waveform])
+            coarse_similarity = torch.nn.functional.cosine_similarity(master_embedding, coarse_embedding).item()
+            if coarse_similarity < current_confidence_threshold - COARSE_SIMILARITY_MARGIN:
+                return 0
+    except Exception as e:
+        # The check is only an optimization; score the segments as usual
+        tqdm.write(f"Warning: Coarse admission check failed for {raw_file_path}. Scoring all segments. Error: {e}")
 
-            chunk_embedding = torch.from_numpy(chunk_embedding_np).to(_device_instance).unsqueeze(0)
+    try:
+        # Similarities stay on the device until the whole file is scored
+        batch_similarities = []
+        for batch_start in range(0, len(segments_idx), EMBEDDING_BATCH_SIZE):
+            batch_idx = segments_idx[batch_start:batch_start + EMBEDDING_BATCH_SIZE].tolist()
+            chunk_embeddings = _embed_waveform_batch([waveform_full[start_idx:end_idx] for start_idx, end_idx in batch_idx])
 
             # Compare embeddings
-            similarity = torch.nn.functional.cosine_similarity(master_embedding, chunk_embedding).item()
+            batch_similarities.append(torch.nn.functional.cosine_similarity(master_embedding, chunk_embeddings))
 
-            if similarity > current_confidence_threshold:
-                found_clips_in_file += 1
-                raw_file_base = os.path.splitext(os.path.basename(raw_file_path))[0]
-                output_filename = f"{speaker_name}_{raw_file_base}_t{start_ms}-{end_ms}_{uuid.uuid4().hex[:4]}.wav"
-                chunk.export(os.path.join(round_output_dir, output_filename), format="wav")
+        # Single device-to-host sync per file, then pick the winners in NumPy
+        similarities = torch.cat(batch_similarities).cpu().numpy()
+        matches = np.flatnonzero(similarities > current_confidence_threshold)
+        for (start_ms, end_ms), (start_idx, end_idx) in zip(segments_ms[matches].tolist(), segments_idx[matches].tolist()):
+            found_clips_in_file += 1
+            output_filename = f"{speaker_name}_{raw_file_base}_t{start_ms}-{end_ms}_{uuid.uuid4().hex[:4]}.wav"
+            _write_wav(os.path.join(round_output_dir, output_filename), pcm[start_idx:end_idx])
 
     except Exception as e:
-        tqdm.write(f"Warning: Worker failed to process raw file {raw_file_path}. Error: {e}")
-        traceback.print_exc() # Print full traceback for worker errors
-        return 0
-    
+        tqdm.write(f"Warning: Failed to extract clips from raw file {raw_file_path}. Error: {e}")
+        traceback.print_exc()
+
     return found_clips_in_file
 
 # --- Main Extraction Logic ---
 
-def extract_samples(speaker_name, num_rounds=3, max_workers=None):
-    """Performs iterative sample extraction for a given speaker using multiprocessing."""
+def extract_samples(speaker_name, num_rounds=3, max_workers=8):
+    """
+    Performs iterative sample extraction for a given speaker.
+    Decoding and VAD run in max_workers threads; embedding runs on the main thread.
+    """
     print(f"--- Starting data extraction pipeline for speaker: {speaker_name} ---")
 
-    # The main process loads models for master embedding generation
-    _init_worker_models()
+    # The main process loads the only copy of the models
+    _init_models()
 
     # 2. Define paths
     initial_sample_path = os.path.join(SPEAKER_SAMPLES_DIR, f"{speaker_name}.mp3")
@@ -237,7 +407,6 @@ def extract_samples(speaker_name, num_rounds=3, max_workers=None):
             return
 
         print("Master embedding generated successfully.")
-        # c. Scan raw audio files and extract matching chunks using multiprocessing
         # --- MODIFIED: Save the calculated embedding for this round ---
         embedding_save_path = os.path.join(speaker_output_dir, f"run_{round_num}_master_embedding.npy")
         try:
@@ -249,26 +418,24 @@ def extract_samples(speaker_name, num_rounds=3, max_workers=None):
 
         raw_files = [os.path.join(RAW_AUDIO_DIR, f) for f in os.listdir(RAW_AUDIO_DIR) if f.lower().endswith(('.wav', '.mp3', '.flac', '.m4a'))]
         found_clips_count = 0
-        
-        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker_models) as executor:
-            futures = [
-                executor.submit(
-                    process_single_raw_audio_file,
+
+        # c. Scan raw audio files and extract matching chunks; decode threads feed the main-thread model
+        master_embedding = torch.from_numpy(master_embedding_np).to(_device_instance).unsqueeze(0)
+        # At most two decoded files per thread are held at once, so decoded audio does not pile up in memory
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            prepared_files = submit_bounded(executor, prepare_raw_audio_file, raw_files, 2 * max_workers)
+            for raw_file_path, future in tqdm(prepared_files, total=len(raw_files), desc=f"VAD & Extracting (Round {round_num})"):
+                prepared = future.result()
+                if prepared is None:
+                    continue
+                found_clips_count += extract_matching_clips(
                     raw_file_path,
-                    master_embedding_np, # This numpy array will be copied to each process
+                    prepared,
+                    master_embedding,
                     current_confidence_threshold,
                     round_output_dir,
                     speaker_name
                 )
-                for raw_file_path in raw_files
-            ]
-
-            for future in tqdm(as_completed(futures), total=len(futures), desc=f"VAD & Extracting (Round {round_num})"):
-                try:
-                    clips_found_in_file = future.result()
-                    found_clips_count += clips_found_in_file
-                except Exception as exc:
-                    tqdm.write(f"Generated an exception during file processing: {exc}")
         
         # --- MODIFIED: Prune 50 largest files after the 1st run ONLY ---
         # This prevents long, non-speech audio segments from poisoning subsequent embeddings
@@ -310,10 +477,6 @@ def extract_samples(speaker_name, num_rounds=3, max_workers=None):
 
 
 if __name__ == "__main__":
-    # Set the start method to 'spawn' for CUDA compatibility with multiprocessing
-    # This must be done at the very beginning of the main block.
-    multiprocessing.set_start_method('spawn', force=True)
-
     parser = argparse.ArgumentParser(description="Iteratively extract speaker samples from a raw dataset.")
     parser.add_argument(
         "-s", "--speaker",
@@ -331,7 +494,7 @@ if __name__ == "__main__":
         "-w", "--workers",
         type=int,
         default=8,
-        help="The number of worker processes to use for parallel audio processing."
+        help="The number of threads to use for parallel audio decoding and VAD."
     )
 
     args = parser.parse_args()
@@ -0,0 +1,78 @@
+"""
+Helpers shared by the scripts that run the pyannote/embedding network on batches of clips:
+padding a batch with its pooling mask, compiling the network, finding audio files, and
+decoding them ahead of the model with a bounded number of files in flight.
+"""
+import os
+from concurrent.futures import wait, FIRST_COMPLETED
+
+import torch
+
+
+def pad_waveforms(model, waveforms, num_samples=None):
+    """
+    Right-pads mono waveforms (1-D numpy arrays or tensors, or (1, T) tensors) into a
+    (B, 1, num_samples) batch, num_samples defaulting to the longest clip. Also returns the
+    (B, frames) weights mask for model(batch, weights=...): padded frames get weight 0, which
+    keeps them out of the statistics pooling so each row matches the unpadded clip's embedding.
+    Both tensors are float32 on the CPU.
+    """
+    waveforms = [torch.as_tensor(w, dtype=torch.float32).reshape(-1) for w in waveforms]
+    if num_samples is None:
+        num_samples = max(w.shape[0] for w in waveforms)
+    batch = torch.zeros((len(waveforms), 1, num_samples), dtype=torch.float32)
+    weights = torch.zeros((len(waveforms), model.num_frames(num_samples)), dtype=torch.float32)
+    for i, waveform in enumerate(waveforms):
+        batch[i, 0, :waveform.shape[0]] = waveform
+        weights[i, :model.num_frames(waveform.shape[0])] = 1.0
+    return batch, weights
+
+
+def compile_embedding_network(model):
+    """
+    Returns the network wrapped in torch.compile. Batch lengths vary with padding, so it is
+    compiled for dynamic shapes rather than with CUDA graphs.
+    """
+    return torch.compile(model, dynamic=True)
+
+
+def add_compile_argument(parser):
+    """Adds the --compile flag that selects compile_embedding_network()."""
+    parser.add_argument("--compile", action="store_true",
+                        help="torch.compile the embedding model. Pays a one-off compile cost; worth it for large directories.")
+
+
+def find_audio_files(input_dir, extensions):
+    """
+    Yields the paths of all files under input_dir whose lowercased extension is in extensions.
+    Uses os.scandir, whose entries carry their file type, so no extra stat per file is needed.
+    """
+    stack = [input_dir]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif os.path.splitext(entry.name)[1].lower() in extensions:
+                    yield entry.path
+
+
+def submit_bounded(executor, fn, items, max_in_flight):
+    """
+    Yields (item, future) for fn(item) as the executor finishes them, in completion order,
+    submitting the next item only as one completes so that at most max_in_flight results
+    (e.g. decoded audio) are held in memory. A future is dropped once yielded.
+    """
+    items_iter = iter(items)
+    in_flight = {}
+    for item in items_iter:
+        in_flight[executor.submit(fn, item)] = item
+        if len(in_flight) >= max_in_flight:
+            break
+    while in_flight:
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield in_flight.pop(future), future
+            next_item = next(items_iter, None)
+            if next_item is not None:
+                in_flight[executor.submit(fn, next_item)] = next_item
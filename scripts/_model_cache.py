@@ -0,0 +1,67 @@
+"""
+Shared loader for the pyannote/embedding model used by the scripts.
+
+The first run downloads the model from the Hugging Face Hub and saves the
+instantiated Model to ~/.cache/auto-muter, so later runs can load it straight
+back with torch.load instead of going through from_pretrained. The cache is
+rebuilt whenever the installed torch or pyannote.audio version changes.
+"""
+import os
+from functools import lru_cache
+
+import torch
+import pyannote.audio
+from pyannote.audio import Inference, Model
+
+# --- Configuration ---
+HF_TOKEN = os.getenv("HF_AUTH_TOKEN")
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "auto-muter")
+MODEL_CACHE_PATH = os.path.join(CACHE_DIR, "pyannote_embedding.pt")
+VERSION_STAMP_PATH = MODEL_CACHE_PATH + ".version"
+
+
+def version_stamp():
+    """Identifies the library versions a cached model was saved with."""
+    return f"torch={torch.__version__};pyannote.audio={pyannote.audio.__version__}"
+
+
+def _load_cached_model(device):
+    """Returns the cached Model, or None if it is missing or stale."""
+    if not os.path.exists(MODEL_CACHE_PATH) or not os.path.exists(VERSION_STAMP_PATH):
+        return None
+    with open(VERSION_STAMP_PATH, "r", encoding="utf-8") as f:
+        if f.read().strip() != version_stamp():
+            print("Cached embedding model was saved with different library versions. Reloading.")
+            return None
+    try:
+        return torch.load(MODEL_CACHE_PATH, map_location=device, weights_only=False)
+    except Exception as e:
+        print(f"Warning: Could not load cached embedding model from {MODEL_CACHE_PATH}. Reloading. Error: {e}")
+        return None
+
+
+def _save_cached_model(model):
+    """Saves the Model and its version stamp. Failures only cost the next run a reload."""
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        torch.save(model, MODEL_CACHE_PATH)
+        with open(VERSION_STAMP_PATH, "w", encoding="utf-8") as f:
+            f.write(version_stamp())
+    except Exception as e:
+        print(f"Warning: Could not cache embedding model to {MODEL_CACHE_PATH}. Error: {e}")
+
+
+@lru_cache(maxsize=1)
+def get_embedding_model():
+    """
+    Returns the pyannote/embedding Inference (window="whole"), on GPU when available.
+    Loaded at most once per process.
+    """
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = _load_cached_model(device)
+    if model is None:
+        model = Model.from_pretrained("pyannote/embedding", use_auth_token=HF_TOKEN)
+        if model is None:
+            raise RuntimeError("Could not load pyannote/embedding. Ensure you have a valid Hugging Face token.")
+        _save_cached_model(model)
+    return Inference(model, window="whole", device=device)
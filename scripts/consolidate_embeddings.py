@@ -0,0 +1,109 @@
+import os
+import argparse
+from collections import Counter
+import numpy as np
+
+# --- Configuration ---
+# Matches OUTPUT_SPEAKERS_DIR in data-processing/extract_speaker_samples.py, which writes
+# <speaker>/run_<N>_master_embedding.npy after every extraction round.
+DEFAULT_SPEAKERS_DIR = "/data/auto-muter/speakers"
+EMBEDDING_SUFFIX = "_master_embedding.npy"
+MATRIX_FILENAME = "matrix.npy"
+IDS_FILENAME = "ids.npy"
+
+
+def find_embedding_files(speakers_dir, latest_only=False):
+    """
+    Returns sorted (id, path) pairs for every master embedding under speakers_dir.
+    The id is '<speaker>/run_<N>'. With latest_only, only each speaker's last round is kept.
+    """
+    entries = []
+    for speaker_entry in sorted(os.scandir(speakers_dir), key=lambda e: e.name):
+        if not speaker_entry.is_dir():
+            continue
+        rounds = []
+        for entry in os.scandir(speaker_entry.path):
+            if entry.is_file() and entry.name.endswith(EMBEDDING_SUFFIX):
+                run_name = entry.name[:-len(EMBEDDING_SUFFIX)]
+                try:
+                    round_num = int(run_name.split("_")[-1])
+                except ValueError:
+                    continue
+                rounds.append((round_num, run_name, entry.path))
+        rounds.sort()
+        if latest_only:
+            rounds = rounds[-1:]
+        entries.extend((f"{speaker_entry.name}/{run_name}", path) for _, run_name, path in rounds)
+    return entries
+
+
+def save_atomically(path, array):
+    """Writes an .npy file next to its destination and renames it into place."""
+    temp_path = path + ".tmp.npy"
+    np.save(temp_path, array)
+    os.replace(temp_path, path)
+
+
+def consolidate_embeddings(speakers_dir, output_dir, latest_only=False):
+    """
+    Stacks the per-round master embeddings into a single (N, D) float16 matrix.npy with a
+    parallel ids.npy, so consumers open one file and can np.load(..., mmap_mode='r') it
+    instead of opening N small files. The width D is the most common embedding size, so a
+    malformed file is skipped rather than deciding the width for every other file.
+    """
+    entries = find_embedding_files(speakers_dir, latest_only)
+    if not entries:
+        print(f"No master embeddings found under {speakers_dir}.")
+        return
+
+    # mmap_mode only reads each file's header, so finding the sizes costs no data reads
+    sizes = {}
+    for _, path in entries:
+        try:
+            sizes[path] = np.load(path, mmap_mode="r").size
+        except Exception as e:
+            print(f"Warning: Skipping {path}: could not be read. Error: {e}")
+    if not sizes:
+        print(f"No readable master embeddings found under {speakers_dir}.")
+        return
+    dimension = Counter(sizes.values()).most_common(1)[0][0]
+
+    matrix = np.empty((len(sizes), dimension), dtype=np.float16)
+    ids = []
+    for embedding_id, path in entries:
+        if path not in sizes:
+            continue
+        if sizes[path] != dimension:
+            print(f"Warning: Skipping {path}: dimension {sizes[path]} does not match {dimension}.")
+            continue
+        matrix[len(ids)] = np.load(path).reshape(-1)
+        ids.append(embedding_id)
+    matrix = matrix[:len(ids)]
+
+    os.makedirs(output_dir, exist_ok=True)
+    save_atomically(os.path.join(output_dir, MATRIX_FILENAME), matrix)
+    save_atomically(os.path.join(output_dir, IDS_FILENAME), np.array(ids))
+    print(f"Wrote {len(ids)} embedding(s) of dimension {matrix.shape[1]} to {output_dir}.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Consolidate per-round master embeddings into a single matrix.npy + ids.npy.")
+    parser.add_argument(
+        "--speakers-dir",
+        type=str,
+        default=DEFAULT_SPEAKERS_DIR,
+        help=f"Directory containing one sub-directory per speaker (default: {DEFAULT_SPEAKERS_DIR})."
+    )
+    parser.add_argument(
+        "--output-dir",
+        type=str,
+        help="Where to write matrix.npy and ids.npy (default: the speakers directory)."
+    )
+    parser.add_argument(
+        "--latest-only",
+        action="store_true",
+        help="Keep only the last extraction round of each speaker."
+    )
+    args = parser.parse_args()
+
+    consolidate_embeddings(args.speakers_dir, args.output_dir or args.speakers_dir, args.latest_only)
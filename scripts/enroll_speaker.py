@@ -1,14 +1,23 @@
 import os
+import sys
 import argparse
 import torch
+import torchaudio
 import numpy as np
-from pyannote.audio import Inference
-from pyannote.core import SlidingWindowFeature
 from pydub import AudioSegment
 from tqdm import tqdm
-import tempfile
 import sqlite3
+import csv
+import hashlib
+from functools import lru_cache
 import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+from _model_cache import get_embedding_model
+from _embedding_batch import add_compile_argument, compile_embedding_network, find_audio_files, pad_waveforms, submit_bounded
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from backend.databases.migrations import ensure_sources_columns, ensure_embedding_cache_table
 
 # --- Configuration ---
 HF_TOKEN = os.getenv("HF_AUTH_TOKEN")
@@ -17,98 +26,308 @@ if not HF_TOKEN:
 
 # --- Database Configuration ---
 DEFAULT_DB_PATH = os.path.join(os.path.dirname(__file__), '..', 'backend', 'databases', 'speakers.db')
+EMBEDDING_DTYPE = "float16"  # Stored in sources.embedding_dtype so readers can decode the BLOB
+
+# --- SQL Statements ---
+# Kept as constants so every call reuses SQLite's cached prepared statement
+_SQL_SELECT_SPEAKER = "SELECT id FROM speakers WHERE name = ?"
+_SQL_INSERT_SPEAKER = "INSERT INTO speakers (name) VALUES (?)"
+_SQL_INSERT_SOURCE = "INSERT INTO sources (speaker_id, source_url, timestamp, embedding, embedding_dtype, audio_sha) VALUES (?, ?, ?, ?, ?, ?)"
+_SQL_SELECT_CACHED_EMBEDDING = "SELECT embedding, embedding_dtype FROM embedding_cache WHERE sha = ?"
+_SQL_INSERT_CACHED_EMBEDDING = "INSERT OR IGNORE INTO embedding_cache (sha, embedding, embedding_dtype) VALUES (?, ?, ?)"
 
-def convert_to_wav(audio_path, target_sr=16000):
+# --- Batching Configuration ---
+EMBED_BATCH = 16  # Maximum number of files per forward pass of the embedding model
+EMBEDDING_DIM = 512  # Output dimension of pyannote/embedding
+AUDIO_EXTENSIONS = frozenset({".wav", ".mp3", ".flac", ".m4a"})
+
+def configure_connection(conn, network_mode=False):
     """
-    Converts an audio file to a temporary WAV file with the target sample rate.
-    Returns the path to the temporary WAV file.
+    Applies the bulk-enrollment PRAGMAs: WAL journal, larger page cache, in-memory temp store
+    and memory-mapped reads. WAL is unsafe on network filesystems (NFS, Lustre), so in
+    network_mode the rollback journal and full syncs are kept.
     """
-    try:
-        audio = AudioSegment.from_file(audio_path)
-        audio = audio.set_frame_rate(target_sr).set_channels(1)
-        
-        temp_wav = tempfile.NamedTemporaryFile(delete=False, suffix=".wav")
-        audio.export(temp_wav.name, format="wav")
-        return temp_wav.name
-    except Exception as e:
-        print(f"Warning: Could not process file {audio_path} with pydub. Skipping. Error: {e}")
-        return None
+    if network_mode:
+        conn.execute("PRAGMA journal_mode=DELETE")
+    else:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA cache_size=-65536")  # 64 MB
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")  # 256 MB
 
-def enroll_speaker_from_path(speaker_name, input_path, source_url, timestamp, db_path):
+@lru_cache(maxsize=1)
+def get_conn(db_path, network_mode=False):
     """
-    Generates a speaker embedding and registers the speaker in the database.
-    The embedding is stored directly in the database as a BLOB.
+    Returns the session's connection to db_path. It is opened, tuned and migrated once,
+    then reused by every enrollment instead of being reopened and closed per call.
     """
-    if not os.path.exists(input_path):
-        print(f"Error: Input path not found at {input_path}")
-        return
-
-    # --- Database Connection ---
     print(f"Connecting to database: {db_path}")
     conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    configure_connection(conn, network_mode)
+    ensure_sources_columns(conn)
+    ensure_embedding_cache_table(conn)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sources_speaker_url_ts ON sources (speaker_id, source_url, timestamp);")
+    return conn
 
-    # --- Check if speaker already exists ---
-    cursor.execute("SELECT id FROM speakers WHERE name = ?", (speaker_name,))
-    speaker_row = cursor.fetchone()
-    
-    if speaker_row:
-        print(f"Speaker '{speaker_name}' already exists. Adding new source to existing speaker.")
-        speaker_id = speaker_row[0]
-    else:
-        print(f"Speaker '{speaker_name}' not found. Creating new speaker entry.")
-        cursor.execute("INSERT INTO speakers (name) VALUES (?)", (speaker_name,))
-        speaker_id = cursor.lastrowid
-        print(f"New speaker '{speaker_name}' created with ID: {speaker_id}")
+def hash_audio_file(audio_path):
+    """Returns the hex SHA-256 of a file's bytes."""
+    with open(audio_path, "rb") as f:
+        if hasattr(hashlib, "file_digest"):  # Python 3.11+
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        return hashlib.sha256(f.read()).hexdigest()
 
-    # --- Model Loading ---
+def load_embedding_model(compile_model=False):
+    """Loads the shared embedding model, optionally wrapped in torch.compile."""
     print("Loading the speaker embedding model (pyannote/embedding)...")
+    inference_model = get_embedding_model()
+    if compile_model:
+        inference_model.model = compile_embedding_network(inference_model.model)
+    print("Model loaded successfully.")
+    return inference_model
+
+# Resamplers keyed by (orig_freq, new_freq); building one designs its filter kernel,
+# and inputs usually share a handful of sample rates (44.1/48 kHz).
+_RESAMPLERS = {}
+
+def _get_resampler(orig_freq, new_freq):
+    """Returns a cached torchaudio Resample transform for the given rates."""
+    key = (orig_freq, new_freq)
+    resampler = _RESAMPLERS.get(key)
+    if resampler is None:
+        resampler = torchaudio.transforms.Resample(orig_freq=orig_freq, new_freq=new_freq)
+        _RESAMPLERS[key] = resampler
+    return resampler
+
+def load_waveform(audio_path, target_sr=16000):
+    """
+    Decodes an audio file into a mono (1, T) float tensor at the target sample rate.
+    Falls back to pydub (ffmpeg) in memory for codecs torchaudio cannot read.
+    """
     try:
-        inference_model = Inference(
-            "pyannote/embedding", 
-            window="whole", 
-            use_auth_token=HF_TOKEN
-        )
-        print("Model loaded successfully.")
-    except Exception as e:
-        print(f"Error loading model. Ensure you have a valid Hugging Face token. Error: {e}")
-        conn.close()
-        return
+        waveform, sr = torchaudio.load(audio_path)
+    except Exception:
+        audio = AudioSegment.from_file(audio_path).set_channels(1)
+        samples = np.array(audio.get_array_of_samples(), dtype=np.float32) / (2**((audio.sample_width * 8) - 1))
+        waveform, sr = torch.from_numpy(samples).unsqueeze(0), audio.frame_rate
+    if waveform.shape[0] > 1:
+        waveform = waveform.mean(0, keepdim=True)
+    if sr != target_sr:
+        waveform = _get_resampler(sr, target_sr)(waveform)
+    return waveform
+
+def _decode_worker(audio_path):
+    """ProcessPool entry point: decodes a file to a mono 16 kHz float32 numpy array."""
+    return load_waveform(audio_path).squeeze(0).numpy()
+
+# Side stream for host-to-device copies, created on first use
+_copy_stream = None
+
+def _to_device(tensor, device):
+    """
+    Moves a CPU tensor to the device. On CUDA the tensor is pinned and copied with
+    non_blocking=True on a side stream, so the transfer overlaps kernels already
+    queued on the compute stream (e.g. the previous batch's forward pass).
+    """
+    global _copy_stream
+    if device.type != "cuda":
+        return tensor.to(device)
+    if _copy_stream is None:
+        _copy_stream = torch.cuda.Stream(device)
+    with torch.cuda.stream(_copy_stream):
+        device_tensor = tensor.pin_memory().to(device, non_blocking=True)
+    compute_stream = torch.cuda.current_stream(device)
+    compute_stream.wait_stream(_copy_stream)
+    device_tensor.record_stream(compute_stream)
+    return device_tensor
+
+def embed_batch(model, waveforms):
+    """
+    Computes embeddings for a list of (1, T) waveforms in a single forward pass,
+    padded and masked by pad_waveforms(). On GPUs with bfloat16 support the forward pass runs under bf16 autocast; the result
+    is cast back to float32 before it is averaged or stored.
+    Returns a (B, D) tensor left on the model device, so no host sync happens here.
+    """
+    batch, weights = pad_waveforms(model, waveforms)
+
+    use_bf16 = model.device.type == "cuda" and torch.cuda.is_bf16_supported()
+    with torch.inference_mode(), torch.autocast(device_type=model.device.type, dtype=torch.bfloat16, enabled=use_bf16):
+        embeddings = model(_to_device(batch, model.device), weights=_to_device(weights, model.device))
+    return embeddings.float()
+
+def compute_embeddings(inference_model, input_path, per_file=False):
+    """
+    Computes the embeddings to store for one enrollment input.
+    A file yields one embedding. A directory yields the average of its files'
+    unit-normalized embeddings, or one embedding per file when per_file is set.
+    """
+    if not os.path.isdir(input_path):
+        # Decode in memory and hand the waveform straight to pyannote
+        waveform = load_waveform(input_path)
+        embedding_output = inference_model({"waveform": waveform, "sample_rate": 16000})
+        # window="whole" always yields a single (D,) / (1, D) embedding
+        return [np.asarray(embedding_output).squeeze()]
+
+    # Decode in worker processes while the main process runs inference on batches of
+    # EMBED_BATCH already-decoded files. Submitting in size order means files finishing
+    # together are of similar length, which keeps padding small.
+    audio_files = sorted(find_audio_files(input_path, AUDIO_EXTENSIONS), key=os.path.getsize)
+    # Averaging only needs a running sum, so per-file embeddings are kept only when per_file is set,
+    # written straight into a buffer preallocated for every file. Both stay on the model device
+    # until every batch has been queued.
+    per_file_embeddings = None
+    if per_file:
+        per_file_embeddings = torch.empty((len(audio_files), EMBEDDING_DIM), dtype=torch.float32, device=inference_model.model.device)
+    running_sum = None
+    count = 0
+    pending = []
+
+    def flush(pending):
+        nonlocal running_sum, count
+        # Unit-normalize each file's embedding first: raw norms vary enough that one file
+        # would otherwise dominate the directory average
+        embeddings = torch.nn.functional.normalize(embed_batch(inference_model.model, pending), dim=-1)
+        if per_file:
+            per_file_embeddings[count:count + len(pending)] = embeddings
+        elif running_sum is None:
+            running_sum = embeddings.sum(dim=0, dtype=torch.float64)
+        else:
+            running_sum += embeddings.sum(dim=0, dtype=torch.float64)
+        count += len(pending)
+
+    # At most two decoded files per worker are held at once, so decoded audio does not pile up in memory
+    max_workers = os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        decoded = submit_bounded(pool, _decode_worker, audio_files, 2 * max_workers)
+        for audio_path, future in tqdm(decoded, total=len(audio_files), desc="Decoding and embedding audio files"):
+            try:
+                pending.append(torch.from_numpy(future.result()).unsqueeze(0))
+            except Exception as e:
+                print(f"Warning: Could not decode {audio_path}. Skipping. Error: {e}")
+                continue
+            if len(pending) == EMBED_BATCH:
+                flush(pending)
+                pending = []
+    if pending:
+        flush(pending)
+
+    if count == 0:
+        raise ValueError(f"No decodable audio files found in {input_path}.")
+
+    if per_file:
+        # Files that failed to decode leave unused rows at the end of the buffer
+        return list(per_file_embeddings[:count].cpu().numpy())
+    return [(running_sum / count).float().cpu().numpy()]
+
+def read_manifest(manifest_path):
+    """
+    Reads a CSV manifest with a header row of name,path,url,timestamp into
+    (speaker_name, input_path, source_url, timestamp) entries. url and timestamp may be empty.
+    """
+    with open(manifest_path, "r", newline="", encoding="utf-8") as f:
+        return [
+            (row["name"], row["path"], row.get("url") or None, row.get("timestamp") or None)
+            for row in csv.DictReader(f)
+        ]
+
+def enroll_speaker_batch(entries, db_path, per_file=False, network_mode=False, compile_model=False):
+    """
+    Generates embeddings for a list of (speaker_name, input_path, source_url, timestamp)
+    entries and registers them in a single transaction with one executemany.
+    Audio is decoded in memory, the model is loaded at most once, and nothing is committed
+    until every entry has been embedded. Embeddings are stored as BLOBs.
+    A file whose bytes are already in embedding_cache (shared with the backend's enrollment
+    endpoint) reuses that embedding without running the model; a newly embedded file is added
+    to it. sources.audio_sha records which file each source came from.
+    """
+    # --- Database Connection ---
+    conn = get_conn(db_path, network_mode)
 
     # --- Audio File Processing ---
-    temp_wav_path = None
+    inference_model = None
+    rows = []
+    cache_rows = []
+    for speaker_name, input_path, source_url, timestamp in entries:
+        if not os.path.exists(input_path):
+            print(f"Error: Input path not found at {input_path}")
+            continue
+        try:
+            audio_sha = None
+            if os.path.isfile(input_path):
+                audio_sha = hash_audio_file(input_path)
+                cached = conn.execute(_SQL_SELECT_CACHED_EMBEDDING, (audio_sha,)).fetchone()
+                if cached:
+                    print(f"Embedding cache hit for {input_path} ({audio_sha[:12]}).")
+                    rows.append((speaker_name, source_url, timestamp, cached[0], cached[1], audio_sha))
+                    continue
+
+            # --- Model Loading (only on the first cache miss) ---
+            if inference_model is None:
+                try:
+                    inference_model = load_embedding_model(compile_model)
+                except Exception as e:
+                    print(f"Error loading model. Ensure you have a valid Hugging Face token. Error: {e}")
+                    return
+
+            for embedding_np in compute_embeddings(inference_model, input_path, per_file):
+                # Store the unit vector so matching is a plain dot product
+                embedding_np = embedding_np / (np.linalg.norm(embedding_np) + 1e-12)
+                # Convert numpy array to float16 bytes for BLOB storage (half the size of float32;
+                # cosine similarity is unaffected at this precision)
+                embedding_blob = embedding_np.astype(EMBEDDING_DTYPE).tobytes()
+                rows.append((speaker_name, source_url, timestamp, embedding_blob, EMBEDDING_DTYPE, audio_sha))
+                if audio_sha is not None:
+                    cache_rows.append((audio_sha, embedding_blob, EMBEDDING_DTYPE))
+        except Exception as e:
+            print(f"\nError during embedding generation for {input_path}: {e}")
+
+    if not rows:
+        print("No embeddings were generated. Nothing to record.")
+        return
+
+    cursor = conn.cursor()
+
     try:
-        temp_wav_path = convert_to_wav(input_path)
-        if temp_wav_path is None:
-            raise ValueError("Failed to convert audio to WAV format.")
-
-        embedding_output = inference_model(temp_wav_path)
-        
-        if isinstance(embedding_output, SlidingWindowFeature):
-            embedding_np = embedding_output.data.mean(axis=0)
-        else:
-            embedding_np = np.asarray(embedding_output)
+        cursor.execute("BEGIN")
+
+        # --- Check if speakers already exist ---
+        speaker_ids = {}
+        for speaker_name in dict.fromkeys(row[0] for row in rows):
+            cursor.execute(_SQL_SELECT_SPEAKER, (speaker_name,))
+            speaker_row = cursor.fetchone()
 
-        # Convert numpy array to bytes for BLOB storage
-        embedding_blob = embedding_np.tobytes()
+            if speaker_row:
+                print(f"Speaker '{speaker_name}' already exists. Adding new source(s) to existing speaker.")
+                speaker_ids[speaker_name] = speaker_row[0]
+            else:
+                print(f"Speaker '{speaker_name}' not found. Creating new speaker entry.")
+                cursor.execute(_SQL_INSERT_SPEAKER, (speaker_name,))
+                speaker_ids[speaker_name] = cursor.lastrowid
+                print(f"New speaker '{speaker_name}' created with ID: {speaker_ids[speaker_name]}")
 
-        # --- Save Embedding and Record Source ---
-        # Add the source information to the database, including the embedding blob
-        cursor.execute(
-            "INSERT INTO sources (speaker_id, source_url, timestamp, embedding) VALUES (?, ?, ?, ?)",
-            (speaker_id, source_url, timestamp, embedding_blob)
+        # --- Save Embeddings and Record Sources ---
+        cursor.executemany(
+            _SQL_INSERT_SOURCE,
+            [(speaker_ids[speaker_name], *row) for speaker_name, *row in rows]
         )
+        cursor.executemany(_SQL_INSERT_CACHED_EMBEDDING, cache_rows)
         conn.commit()
-        print("Source information and embedding successfully recorded in the database.")
+        print(f"{len(rows)} source(s) and embedding(s) successfully recorded in the database.")
 
     except Exception as e:
-        print(f"\nError during embedding generation or database operation: {e}")
+        print(f"\nError during database operation: {e}")
         conn.rollback() # Rollback changes on error
     finally:
-        if temp_wav_path and os.path.exists(temp_wav_path):
-            os.remove(temp_wav_path)
-        conn.close()
-        print("Database connection closed.")
+        cursor.close()
+
+def enroll_speaker_from_path(speaker_name, input_path, source_url, timestamp, db_path, per_file=False, network_mode=False, compile_model=False):
+    """
+    Generates a speaker embedding and registers the speaker in the database.
+    If input_path is a directory, the embeddings of all audio files in it are
+    computed in batched forward passes and averaged into a single source entry,
+    or stored as one source entry per file when per_file is set.
+    """
+    enroll_speaker_batch([(speaker_name, input_path, source_url, timestamp)], db_path, per_file, network_mode, compile_model)
 
 
 if __name__ == "__main__":
@@ -116,14 +335,17 @@ if __name__ == "__main__":
     parser.add_argument(
         "-n", "--name", 
         type=str, 
-        required=True, 
         help="The name of the speaker."
     )
     parser.add_argument(
         "-i", "--input_path", 
         type=str, 
-        required=True, 
-        help="Path to the audio file for enrollment."
+        help="Path to the audio file, or a directory of audio files, for enrollment."
+    )
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        help="Path to a CSV file (header: name,path,url,timestamp) listing several enrollments to record in one transaction. Replaces -n/-i."
     )
     parser.add_argument(
         "--url", 
@@ -141,7 +363,23 @@ if __name__ == "__main__":
         default=DEFAULT_DB_PATH,
         help="Path to the speaker database file."
     )
+    parser.add_argument(
+        "--per-file",
+        action="store_true",
+        help="When the input path is a directory, record one source per audio file instead of averaging them."
+    )
+    parser.add_argument(
+        "--network-mode",
+        action="store_true",
+        help="The database is on a network filesystem (e.g. NFS): keep the rollback journal instead of WAL."
+    )
+    add_compile_argument(parser)
     
     args = parser.parse_args()
-    
-    enroll_speaker_from_path(args.name, args.input_path, args.url, args.timestamp, args.db_path)
+
+    if args.manifest:
+        enroll_speaker_batch(read_manifest(args.manifest), args.db_path, args.per_file, args.network_mode, args.compile)
+    elif args.name and args.input_path:
+        enroll_speaker_from_path(args.name, args.input_path, args.url, args.timestamp, args.db_path, args.per_file, args.network_mode, args.compile)
+    else:
+        parser.error("either --manifest or both -n/--name and -i/--input_path are required")
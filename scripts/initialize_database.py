@@ -1,6 +1,19 @@
 
 import sqlite3
 import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from backend.databases.migrations import ensure_sources_columns
+
+parser = argparse.ArgumentParser(description="Initialize the speaker database schema.")
+parser.add_argument(
+    "--network-mode",
+    action="store_true",
+    help="The database is on a network filesystem (e.g. NFS): keep the rollback journal instead of WAL."
+)
+args = parser.parse_args()
 
 # Define the path for the database.
 # It's placed in the backend directory, where it will be used by the FastAPI app.
@@ -14,6 +27,18 @@ try:
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
 
+    # --- Connection tuning ---
+    # WAL avoids writing every change twice and lets readers run during enrollment.
+    # It is unsafe on network filesystems, where the rollback journal is kept.
+    if args.network_mode:
+        cursor.execute("PRAGMA journal_mode=DELETE;")
+    else:
+        cursor.execute("PRAGMA journal_mode=WAL;")
+        cursor.execute("PRAGMA synchronous=NORMAL;")
+    cursor.execute("PRAGMA cache_size=-65536;")
+    cursor.execute("PRAGMA temp_store=MEMORY;")
+    cursor.execute("PRAGMA mmap_size=268435456;")
+
     # --- Create the 'speakers' table ---
     # This table stores the unique names of the speakers.
     cursor.execute("""
@@ -33,15 +58,34 @@ try:
         source_url TEXT,
         timestamp TEXT,
         embedding BLOB NOT NULL,
+        embedding_dtype TEXT NOT NULL DEFAULT 'float32',
+        audio_sha TEXT,
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         FOREIGN KEY (speaker_id) REFERENCES speakers (id)
     );
     """)
     print("Table 'sources' created or already exists.")
 
+    # Databases created before embedding_dtype or audio_sha existed get the columns added in place
+    for column in ensure_sources_columns(conn):
+        print(f"Column 'sources.{column}' added.")
+
+    # --- Create the 'embedding_cache' table ---
+    # This table maps the SHA-256 of enrollment audio to its embedding, so re-enrolling
+    # the same clip can skip inference.
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS embedding_cache (
+        sha TEXT PRIMARY KEY,
+        embedding BLOB NOT NULL,
+        embedding_dtype TEXT NOT NULL DEFAULT 'float32'
+    );
+    """)
+    print("Table 'embedding_cache' created or already exists.")
+
     # --- Create indexes for faster lookups ---
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_speaker_name ON speakers (name);")
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_source_speaker_id ON sources (speaker_id);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sources_speaker_url_ts ON sources (speaker_id, source_url, timestamp);")
     print("Indexes created or already exist.")
 
     conn.commit()
@@ -1,149 +1,755 @@
 import torch
-from pyannote.audio import Inference
-import io
+import numpy as np
 import os
-from pydub import AudioSegment
+import subprocess
 import argparse
-from pyannote.core import SlidingWindowFeature
+import json
+import socket
 import warnings
+import hashlib
+from functools import lru_cache
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from _model_cache import MODEL_CACHE_PATH, get_embedding_model, version_stamp
+from _embedding_batch import add_compile_argument, compile_embedding_network, find_audio_files, pad_waveforms
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+try:
+    import triton
+    import triton.language as tl
+except ImportError:
+    triton = None
 
 # --- Configuration ---
-HF_TOKEN = os.getenv("HF_AUTH_TOKEN") # Replace with your actual token if not using env var
 TARGET_SPEAKER_MP3 = "target_speaker.mp3" # Make sure this file exists in the same directory or provide full path
+MODEL_ID = "pyannote/embedding"
+EMBEDDING_PIPELINE_VERSION = 2 # Bump whenever the embedding computed for a given file changes; 2 = windowed long clips
+SERVER_SOCKET_PATH = os.path.join(os.environ.get("XDG_RUNTIME_DIR") or f"/tmp/auto-muter-{os.getuid()}", "auto-muter.sock") # Where similarity_server.py listens; per-user, not shared /tmp
+EMBEDDING_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "auto-muter", "embeddings")
+EMBEDDING_CACHE_MAX_FILES = int(os.getenv("AUTO_MUTER_EMBEDDING_CACHE_MAX_FILES", "10000")) # Least recently used entries are evicted beyond this
+BATCH_SIZE = 16 # Files embedded per forward pass in directory mode
+DECODE_WORKERS = 4 # Threads reading and decoding files while the model runs; ffmpeg runs in subprocesses, so they overlap
+THRESHOLD = 0.65
+SILENCE_RMS_THRESHOLD = 1e-3 # Decoded clips quieter than this (in [-1, 1] amplitude) skip the model and score 0.0
+SAMPLE_RATE = 16000
+AUDIO_EXTENSIONS = frozenset({".mp3", ".wav", ".flac", ".ogg", ".webm"}) # Add more audio extensions if needed
+WARMUP_SECONDS = 3 # Length of the dummy clip used to trigger compilation before real inputs arrive
+STREAM_MIN_SECONDS = 60 # Clips longer than this are embedded window by window instead of in one forward pass
+STREAM_WINDOW_SECONDS = 3 # Window length for long clips
+STREAM_STEP_SECONDS = 1.5 # Hop between windows (50% overlap)
+STREAM_WINDOW_BATCH = 32 # Windows per forward pass; bounds peak activation memory for long clips
+CUDA_GRAPH_SECONDS = 10 # Fixed clip length a captured CUDA graph is padded to; longer clips run eagerly
+SOXR_PRECISION = 20 # Bits of precision for ffmpeg's soxr resampler; 20 matches soxr's "HQ" preset
+ONNX_MODEL_PATH = os.path.join(os.path.expanduser("~"), ".cache", "auto-muter", "pyannote_embedding.onnx")
+ONNX_INT8_MODEL_PATH = os.path.join(os.path.expanduser("~"), ".cache", "auto-muter", "pyannote_embedding.int8.onnx")
+ONNX_OPSET = 17
+# int8 weights are opt-in until their scores have been checked against float32 on a held-out set
+ONNX_USE_INT8 = os.getenv("AUTO_MUTER_ONNX_INT8", "0") == "1"
 
-# --- Initialize Model ---
-try:
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    print(f"Using device: {device}")
-    # Crucially, ensure 'window="whole"' is used for single embedding extraction
-    inference_model = Inference("pyannote/embedding", device=device, use_auth_token=HF_TOKEN, window="whole")
-    print("pyannote/embedding model loaded successfully.")
-except Exception as e:
-    print(f"Error loading pyannote/embedding model: {e}")
-    print("Please ensure you have a valid Hugging Face token and necessary dependencies installed.")
-    exit(1)
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+def get_model():
+    """
+    Returns the pyannote/embedding Inference (window="whole"), loading it on first use so that
+    --help, argument errors and client mode never pay for the model.
+    """
+    try:
+        return get_embedding_model()
+    except Exception as e:
+        print(f"Error loading pyannote/embedding model: {e}")
+        print("Please ensure you have a valid Hugging Face token and necessary dependencies installed.")
+        exit(1)
 
 target_speaker_embedding = None
+_cuda_graph = None # (graph, static_batch, static_weights, static_output) once captured
+_ort_session = None # onnxruntime.InferenceSession used instead of the PyTorch model on CPU
+_ort_precision = None # "fp32" or "int8", matching the ONNX model _ort_session was loaded from
+_ort_version = None # Short hash of the version stamp of the ONNX model _ort_session was loaded from
 
-def load_target_speaker_embedding(mp3_path: str):
-    """Loads and computes the embedding for the target speaker MP3."""
-    global target_speaker_embedding
+@contextmanager
+def _infer_ctx(cache_enabled=True):
+    """
+    Disables autograd for the forward pass and, on CUDA, runs it under float16 autocast.
+    CUDA graph capture needs cache_enabled=False so autocast does not keep casts made during capture.
+    """
+    with torch.inference_mode(), torch.autocast(device_type="cuda", dtype=torch.float16, enabled=device.type == "cuda", cache_enabled=cache_enabled):
+        yield
+
+def _inference_backend() -> str:
+    """
+    Names the backend and precision currently producing embeddings, e.g. "torch-cuda-fp16" or
+    "onnx-int8-<version>". Embeddings from different backends differ slightly, so cached ones are keyed by it.
+    """
+    if _ort_session is not None:
+        return f"onnx-{_ort_precision}-{_ort_version}"
+    return f"torch-{device.type}-{'fp16' if device.type == 'cuda' else 'fp32'}"
+
+def _prune_embedding_cache():
+    """
+    Deletes the least recently used cache entries beyond EMBEDDING_CACHE_MAX_FILES.
+    Scans the whole cache directory, so call it once per batch of writes rather than per entry.
+    """
+    try:
+        with os.scandir(EMBEDDING_CACHE_DIR) as it:
+            entries = [e for e in it if e.name.endswith(".pt")]
+        if len(entries) <= EMBEDDING_CACHE_MAX_FILES:
+            return
+        entries.sort(key=lambda e: e.stat().st_mtime)
+    except OSError as e:
+        print(f"Warning: Could not scan embedding cache {EMBEDDING_CACHE_DIR}. Error: {e}")
+        return
+    for entry in entries[:len(entries) - EMBEDDING_CACHE_MAX_FILES]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+
+def _embedding_cache_path(audio_data: bytes) -> str:
+    """
+    Returns the cache file for the raw audio bytes, keyed by the SHA-256 of the model id,
+    the embedding pipeline version, the inference backend and the contents.
+    """
+    hasher = hashlib.sha256(f"{MODEL_ID}\0v{EMBEDDING_PIPELINE_VERSION}\0{_inference_backend()}\0".encode("utf-8"))
+    hasher.update(audio_data)
+    return os.path.join(EMBEDDING_CACHE_DIR, f"{hasher.hexdigest()}.pt")
+
+def _load_cached_embedding(cache_path: str):
+    """Returns the cached embedding on the model device, or None on a miss. Bumps the entry's mtime on a hit."""
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        embedding = torch.load(cache_path, map_location=device)
+        os.utime(cache_path)
+        print(f"Embedding cache hit: {cache_path}")
+        return embedding
+    except Exception as e:
+        print(f"Warning: Could not read cached embedding {cache_path}. Recomputing. Error: {e}")
+        return None
+
+def _store_cached_embedding(cache_path: str, embedding: torch.Tensor):
+    """Writes the embedding to the cache. Failures only cost a recompute on the next run."""
+    try:
+        os.makedirs(EMBEDDING_CACHE_DIR, exist_ok=True)
+        temp_path = cache_path + ".tmp"
+        # clone() so a row of a batch is saved without the rest of the batch's storage
+        torch.save(embedding.detach().cpu().clone(), temp_path)
+        os.replace(temp_path, cache_path)
+    except Exception as e:
+        print(f"Warning: Could not cache embedding to {cache_path}. Error: {e}")
+
+def cached_embed(audio_data: bytes, compute_embedding) -> torch.Tensor:
+    """
+    Returns the embedding for the raw audio bytes, calling compute_embedding() only on a cache miss.
+    Entries are keyed by the SHA-256 of the model id, pipeline version, inference backend and file contents, and their mtime is
+    bumped on every hit so eviction drops the least recently used ones.
+    """
+    cache_path = _embedding_cache_path(audio_data)
+    embedding = _load_cached_embedding(cache_path)
+    if embedding is None:
+        embedding = compute_embedding()
+        _store_cached_embedding(cache_path, embedding)
+        _prune_embedding_cache()
+    return embedding
+
+def _target_embedding_path(mp3_path: str) -> str:
+    """Returns where the prepared target embedding is persisted, e.g. target_speaker.emb.pt next to target_speaker.mp3."""
+    return os.path.splitext(mp3_path)[0] + ".emb.pt"
+
+def _load_prepared_target(mp3_path: str):
+    """
+    Returns the persisted normalized target embedding if it was saved for the current mp3 mtime
+    by the current pipeline version and inference backend, else None.
+    """
+    emb_path = _target_embedding_path(mp3_path)
+    if not os.path.exists(emb_path):
+        return None
+    try:
+        saved = torch.load(emb_path, map_location=device)
+        if saved["mtime_ns"] != os.stat(mp3_path).st_mtime_ns:
+            print(f"{mp3_path} changed since {emb_path} was written. Recomputing.")
+            return None
+        if saved.get("pipeline_version") != EMBEDDING_PIPELINE_VERSION:
+            print(f"{emb_path} was computed by an older embedding pipeline. Recomputing.")
+            return None
+        if saved.get("backend") != _inference_backend():
+            print(f"{emb_path} was computed with a different inference backend. Recomputing.")
+            return None
+        return saved["embedding"]
+    except Exception as e:
+        print(f"Warning: Could not read prepared target embedding {emb_path}. Recomputing. Error: {e}")
+        return None
+
+def _save_prepared_target(mp3_path: str, embedding: torch.Tensor):
+    """Persists the normalized target embedding with the mp3 mtime, pipeline version and inference backend it was computed from."""
+    emb_path = _target_embedding_path(mp3_path)
+    try:
+        temp_path = emb_path + ".tmp"
+        metadata = {
+            "mtime_ns": os.stat(mp3_path).st_mtime_ns,
+            "pipeline_version": EMBEDDING_PIPELINE_VERSION,
+            "backend": _inference_backend()
+        }
+        torch.save({**metadata, "embedding": embedding.cpu()}, temp_path)
+        os.replace(temp_path, emb_path)
+    except Exception as e:
+        print(f"Warning: Could not save prepared target embedding to {emb_path}. Error: {e}")
+
+def prepare_target_embedding(mp3_path: str):
+    """
+    Loads and computes the embedding for one target speaker MP3.
+    The result is always a contiguous, unit-length (1, D) float32 tensor on the model device.
+    It is persisted next to the mp3 and reused while the mp3's mtime is unchanged.
+    Returns None if the file is missing or cannot be embedded.
+    """
     if not os.path.exists(mp3_path):
         print(f"Error: Target speaker MP3 not found at {mp3_path}")
-        target_speaker_embedding = None
-        return
+        return None
 
     try:
         print(f"Attempting to load target speaker embedding from {mp3_path}...")
-        embedding_output = inference_model(mp3_path)
-        if isinstance(embedding_output, SlidingWindowFeature):
-            target_speaker_embedding = torch.from_numpy(embedding_output.data).mean(axis=0, keepdim=True).to(device)
-        elif isinstance(embedding_output, torch.Tensor):
-            target_speaker_embedding = embedding_output.to(device)
-        else: # Handle case if it's a numpy array directly
-            target_speaker_embedding = torch.from_numpy(embedding_output).to(device)
-
-        # Ensure the embedding is 2D (batch_size, embedding_dim)
-        if target_speaker_embedding.dim() == 1:
-            target_speaker_embedding = target_speaker_embedding.unsqueeze(0)
+        prepared = _load_prepared_target(mp3_path)
+        if prepared is not None:
+            print("Target speaker embedding loaded from disk.")
+            return prepared.to(device)
+
+        with open(mp3_path, "rb") as f:
+            audio_data = f.read()
+
+        def compute_embedding():
+            samples = decode_to_mono16k(mp3_path)
+            if len(samples) > STREAM_MIN_SECONDS * SAMPLE_RATE:
+                return embed_long_waveform(samples)
+            # Same path as the files it is compared against, so both sides come from the same backend
+            return embed_waveform_batch([samples])[0]
+
+        embedding = cached_embed(audio_data, compute_embedding)
+        # Normalize once so each comparison is a plain dot product
+        embedding = torch.nn.functional.normalize(embedding.view(1, -1).float(), p=2, dim=-1).to(device).contiguous()
+        _save_prepared_target(mp3_path, embedding)
 
         print("Target speaker embedding loaded successfully.")
+        return embedding
     except Exception as e:
         print(f"Error loading target speaker embedding from {mp3_path}: {e}")
-        target_speaker_embedding = None
+        return None
 
-def calculate_similarity(target_speaker_embedding, audio_file_path: str) -> tuple[bool, float]:
+def load_target_speaker_embeddings(mp3_paths: list):
     """
-    Calculates the similarity of an audio file to the target speaker.
-    Saves the incoming raw audio data if decoding or processing fails.
+    Sets target_speaker_embedding to the stacked (K, D) matrix of the given target speakers,
+    so one (B, D) @ (D, K) product scores a whole batch against every target.
+    Leaves it as None if any target fails to load.
     """
-    if target_speaker_embedding is None:
-        print("Target speaker embedding not loaded. Cannot perform detection.")
-        return False, 0.0
+    global target_speaker_embedding
+    embeddings = [prepare_target_embedding(mp3_path) for mp3_path in mp3_paths]
+    if any(embedding is None for embedding in embeddings):
+        target_speaker_embedding = None
+        return
+    target_speaker_embedding = torch.cat(embeddings, dim=0).contiguous()
 
-    print(f"Processing audio file: {audio_file_path}")
+def load_target_speaker_embedding(mp3_path: str):
+    """Loads the embedding for a single target speaker MP3 as a (1, D) matrix."""
+    load_target_speaker_embeddings([mp3_path])
 
+@lru_cache(maxsize=1)
+def _ffmpeg_has_soxr() -> bool:
+    """Returns True if the installed ffmpeg was built with libsoxr."""
     try:
-        with open(audio_file_path, "rb") as f:
-            audio_data = f.read()
+        result = subprocess.run(["ffmpeg", "-hide_banner", "-buildconf"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=False)
+    except OSError:
+        return False
+    has_soxr = b"--enable-libsoxr" in result.stdout
+    if not has_soxr:
+        print("WARNING: ffmpeg was built without libsoxr. Falling back to its default resampler.")
+    return has_soxr
+
+def decode_to_mono16k(audio_file_path: str) -> np.ndarray:
+    """
+    Decodes an audio file into a mono 16 kHz float32 waveform in [-1, 1].
+    A single ffmpeg process decodes, downmixes and resamples straight to raw PCM on stdout,
+    using the SIMD soxr resampler when ffmpeg has it.
+    """
+    command = ["ffmpeg", "-nostdin", "-loglevel", "error", "-i", audio_file_path, "-ac", "1"]
+    if _ffmpeg_has_soxr():
+        command += ["-af", f"aresample=resampler=soxr:precision={SOXR_PRECISION}"]
+    command += ["-ar", str(SAMPLE_RATE), "-f", "s16le", "-"]
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to decode {audio_file_path}: {result.stderr.decode(errors='replace').strip()}")
+    samples = np.frombuffer(result.stdout, dtype=np.int16).astype(np.float32) / 32768.0
+    print(f"ffmpeg decode successful. Length: {len(samples) / SAMPLE_RATE:.2f}s")
+    return samples
+
+def embed_waveform_batch(waveforms: list) -> torch.Tensor:
+    """
+    Embeds a list of mono numpy waveforms in one forward pass, padded and masked by
+    pad_waveforms(), on whichever backend is active (ONNX Runtime, CUDA graph or eager PyTorch).
+    Returns a (B, D) float32 tensor on the model device; on CUDA the forward pass itself runs in float16.
+    """
+    if _ort_session is not None:
+        return _embed_with_onnx(waveforms)
+
+    if _cuda_graph is not None:
+        static_batch = _cuda_graph[1]
+        if len(waveforms) <= static_batch.shape[0] and max(len(w) for w in waveforms) <= static_batch.shape[-1]:
+            return _replay_cuda_graph(waveforms)
+
+    model = get_model().model
+    batch, weights = pad_waveforms(model, waveforms)
+
+    if device.type == "cuda":
+        # Pinned host memory lets the copies run without blocking on queued kernels
+        batch, weights = batch.pin_memory(), weights.pin_memory()
+    with _infer_ctx():
+        embeddings = model(batch.to(device, non_blocking=True), weights=weights.to(device, non_blocking=True))
+    return embeddings.float()
+
+def embed_long_waveform(waveform: np.ndarray) -> torch.Tensor:
+    """
+    Embeds a long mono waveform as the mean of its window embeddings, so memory stays bounded
+    by STREAM_WINDOW_BATCH windows however long the clip is.
+    The clip is cut into STREAM_WINDOW_SECONDS windows with a STREAM_STEP_SECONDS hop (plus one
+    window flush with the end so the tail is covered); the windows go through the model in
+    batches, and their unit-length embeddings are averaged and renormalized.
+    Returns a unit-length (D,) float32 tensor on the model device.
+    """
+    window = STREAM_WINDOW_SECONDS * SAMPLE_RATE
+    step = int(STREAM_STEP_SECONDS * SAMPLE_RATE)
+    frames = torch.from_numpy(waveform).unfold(0, window, step)
+    if (len(waveform) - window) % step:
+        frames = torch.cat([frames, torch.from_numpy(waveform[-window:]).unsqueeze(0)])
 
-        print(f"Received {len(audio_data)} bytes for processing from {audio_file_path}.")
+    embedding_sum = None
+    for start in range(0, frames.shape[0], STREAM_WINDOW_BATCH):
+        window_embeddings = embed_waveform_batch(list(frames[start:start + STREAM_WINDOW_BATCH].numpy()))
+        window_sum = torch.nn.functional.normalize(window_embeddings, p=2, dim=-1).sum(dim=0)
+        embedding_sum = window_sum if embedding_sum is None else embedding_sum + window_sum
+    return torch.nn.functional.normalize(embedding_sum / frames.shape[0], p=2, dim=-1)
 
-        audio_segment = AudioSegment.from_file(io.BytesIO(audio_data), format=audio_file_path.split('.')[-1])
-        print(f"pydub conversion successful. Length: {audio_segment.duration_seconds:.2f}s")
+def capture_cuda_graph(batch_size: int, seconds: int):
+    """
+    Records one forward pass over a fixed (batch_size, 1, seconds * 16 kHz) input as a CUDA graph.
+    Batches that fit are then padded to that shape and replayed, which skips the per-kernel
+    launch overhead that dominates inference on short clips. The padding is masked out of the
+    statistics pooling exactly as in the eager path.
+    """
+    global _cuda_graph
+    if device.type != "cuda":
+        print("WARNING: CUDA graphs need a CUDA device. Running the model eagerly.")
+        return
 
-        if audio_segment.frame_rate != 16000 or audio_segment.channels != 1:
-            print(f"Resampling audio from {audio_segment.frame_rate}Hz, {audio_segment.channels} channels to 16000Hz, 1 channel.")
-            audio_segment = audio_segment.set_frame_rate(16000).set_channels(1)
+    model = get_model().model
+    num_samples = seconds * SAMPLE_RATE
+    static_batch = torch.empty((batch_size, 1, num_samples), device=device).uniform_(-0.1, 0.1)
+    static_weights = torch.ones((batch_size, model.num_frames(num_samples)), device=device)
 
-        wav_file_in_memory = io.BytesIO()
-        audio_segment.export(wav_file_in_memory, format="wav")
-        wav_file_in_memory.seek(0)
-        print("Audio exported to WAV in memory.")
+    # Warm up on a side stream so lazy initialisation does not end up inside the capture
+    stream = torch.cuda.Stream()
+    stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(stream), _infer_ctx(cache_enabled=False):
+        for _ in range(3):
+            model(static_batch, weights=static_weights)
+    torch.cuda.current_stream().wait_stream(stream)
 
-        # Compute embedding for the live audio chunk
-        live_audio_embedding_output = inference_model(wav_file_in_memory)
+    graph = torch.cuda.CUDAGraph()
+    with torch.cuda.graph(graph), _infer_ctx(cache_enabled=False):
+        static_output = model(static_batch, weights=static_weights)
+    _cuda_graph = (graph, static_batch, static_weights, static_output)
+    print(f"Captured CUDA graph for batches of up to {batch_size} clip(s) of up to {seconds}s.")
 
-        # --- FIX START ---
-        # Ensure live_audio_embedding is a PyTorch Tensor
-        if isinstance(live_audio_embedding_output, SlidingWindowFeature):
-            # If it's a SlidingWindowFeature, extract data and convert to Tensor
-            live_audio_embedding = torch.from_numpy(live_audio_embedding_output.data).mean(axis=0, keepdim=True).to(device)
-            print(f"Converted SlidingWindowFeature to Tensor. Shape: {live_audio_embedding.shape}")
-        elif isinstance(live_audio_embedding_output, torch.Tensor):
-            # It's already a Tensor, just ensure it's on the correct device
-            live_audio_embedding = live_audio_embedding_output.to(device)
-        else: # This handles the case where it might be a numpy array directly
-            live_audio_embedding = torch.from_numpy(live_audio_embedding_output).to(device)
-            print(f"Converted numpy array to Tensor. Shape: {live_audio_embedding.shape}")
+def _replay_cuda_graph(waveforms: list) -> torch.Tensor:
+    """Copies the waveforms into the captured graph's static inputs, replays it and returns a (B, D) float32 copy."""
+    graph, static_batch, static_weights, static_output = _cuda_graph
+    batch, weights = pad_waveforms(get_model().model, waveforms, static_batch.shape[-1])
 
-        # Ensure both embeddings have the same number of dimensions (e.g., [1, D])
-        if live_audio_embedding.dim() == 1:
-            live_audio_embedding = live_audio_embedding.unsqueeze(0)
-        if target_speaker_embedding.dim() == 1:
-            target_speaker_embedding = target_speaker_embedding.unsqueeze(0) # This should ideally be handled in load_target_speaker_embedding
-        # --- FIX END ---
+    static_batch[:len(waveforms)].copy_(batch.pin_memory(), non_blocking=True)
+    # Unused rows keep full weights so their (discarded) pooling does not divide by zero
+    static_weights.fill_(1.0)
+    static_weights[:len(waveforms)].copy_(weights.pin_memory(), non_blocking=True)
+    graph.replay()
+    return static_output[:len(waveforms)].float().clone()
 
+def _export_onnx_model():
+    """Exports the embedding network to ONNX_MODEL_PATH with dynamic batch and sample axes."""
+    print(f"Exporting the embedding model to {ONNX_MODEL_PATH}...")
+    model = get_model().model
+    num_samples = WARMUP_SECONDS * SAMPLE_RATE
+    dummy_batch = torch.zeros((1, 1, num_samples), dtype=torch.float32)
+    dummy_weights = torch.ones((1, model.num_frames(num_samples)), dtype=torch.float32)
+    os.makedirs(os.path.dirname(ONNX_MODEL_PATH), exist_ok=True)
+    temp_path = ONNX_MODEL_PATH + ".tmp"
+    with torch.inference_mode():
+        torch.onnx.export(
+            model, (dummy_batch, dummy_weights), temp_path,
+            input_names=["waveforms", "weights"], output_names=["embeddings"],
+            dynamic_axes={"waveforms": {0: "batch", 2: "samples"}, "weights": {0: "batch", 1: "frames"}, "embeddings": {0: "batch"}},
+            opset_version=ONNX_OPSET
+        )
+    os.replace(temp_path, ONNX_MODEL_PATH)
 
-        # Compare embeddings using cosine similarity
-        similarity = torch.nn.functional.cosine_similarity(live_audio_embedding, target_speaker_embedding)
+def _quantize_onnx_model():
+    """Writes an int8 dynamically quantized copy of the exported model to ONNX_INT8_MODEL_PATH."""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
 
-        THRESHOLD = 0.65
-        is_target = similarity.item() > THRESHOLD
-        print(f"Similarity: {similarity.item():.4f}, Is Target: {is_target}")
-        return is_target, similarity.item()
+    print(f"Quantizing the embedding model to int8 at {ONNX_INT8_MODEL_PATH}...")
+    temp_path = ONNX_INT8_MODEL_PATH + ".tmp"
+    quantize_dynamic(ONNX_MODEL_PATH, temp_path, weight_type=QuantType.QInt8)
+    os.replace(temp_path, ONNX_INT8_MODEL_PATH)
 
+def _onnx_version_stamp() -> str:
+    """
+    Identifies what an exported ONNX model was built from: the library versions, the opset and the
+    cached PyTorch model it was exported from, which _model_cache rebuilds on upgrades.
+    """
+    model_mtime_ns = os.stat(MODEL_CACHE_PATH).st_mtime_ns if os.path.exists(MODEL_CACHE_PATH) else 0
+    return f"{version_stamp()};onnxruntime={onnxruntime.__version__};opset={ONNX_OPSET};model_mtime_ns={model_mtime_ns}"
+
+def _onnx_model_is_current(model_path: str, stamp: str) -> bool:
+    """Returns True if model_path exists and was written with the given version stamp."""
+    stamp_path = model_path + ".version"
+    if not os.path.exists(model_path) or not os.path.exists(stamp_path):
+        return False
+    with open(stamp_path, "r", encoding="utf-8") as f:
+        return f.read().strip() == stamp
+
+def _write_onnx_version_stamp(model_path: str, stamp: str):
+    with open(model_path + ".version", "w", encoding="utf-8") as f:
+        f.write(stamp)
+
+def setup_onnx_runtime():
+    """
+    On CPU, replaces the PyTorch forward pass with an ONNX Runtime session, exporting the model
+    on first use. ORT fuses Conv+BN+activation chains and runs them on its vectorized kernels
+    across all cores. With AUTO_MUTER_ONNX_INT8=1 the weights are dynamically quantized to int8.
+    Exported models are rebuilt when their version stamp no longer matches.
+    Falls back to PyTorch if onnxruntime is missing or the export fails.
+    """
+    global _ort_session, _ort_precision, _ort_version
+    if device.type != "cpu":
+        return
+    if onnxruntime is None:
+        print("WARNING: onnxruntime not installed. Running the embedding model with PyTorch on CPU.")
+        return
+    try:
+        stamp = _onnx_version_stamp()
+        if not _onnx_model_is_current(ONNX_MODEL_PATH, stamp):
+            _export_onnx_model()
+            stamp = _onnx_version_stamp() # The export may have just populated the model cache
+            _write_onnx_version_stamp(ONNX_MODEL_PATH, stamp)
+        model_path, precision = ONNX_MODEL_PATH, "fp32"
+        if ONNX_USE_INT8:
+            try:
+                if not _onnx_model_is_current(ONNX_INT8_MODEL_PATH, stamp):
+                    _quantize_onnx_model()
+                    _write_onnx_version_stamp(ONNX_INT8_MODEL_PATH, stamp)
+                model_path, precision = ONNX_INT8_MODEL_PATH, "int8"
+            except Exception as e:
+                print(f"WARNING: Could not quantize the embedding model. Using the float32 ONNX model. Error: {e}")
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = os.cpu_count() or 1
+        _ort_session = onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        _ort_precision = precision
+        _ort_version = hashlib.sha256(stamp.encode("utf-8")).hexdigest()[:12]
+        print(f"Using ONNX Runtime for the embedding model ({model_path}).")
     except Exception as e:
-        print(f"Error processing audio file {audio_file_path}: {e}")
-        return False, 0.0
+        print(f"WARNING: Could not set up ONNX Runtime. Running the embedding model with PyTorch. Error: {e}")
+        _ort_session = None
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Calculate audio similarity to a target speaker.")
-    parser.add_argument("--input_path", type=str, required=True,
-                        help="Path to an audio file (e.g., .webm, .mp3) or a directory containing audio files to analyze.")
-    parser.add_argument("--target_speaker", type=str, default=TARGET_SPEAKER_MP3,
-                        help=f"Path to the target speaker MP3 file (default: {TARGET_SPEAKER_MP3}).")
-    args = parser.parse_args()
+def _embed_with_onnx(waveforms: list) -> torch.Tensor:
+    """ONNX Runtime counterpart of the eager path in embed_waveform_batch()."""
+    batch, weights = pad_waveforms(get_model().model, waveforms)
+    embeddings, = _ort_session.run(["embeddings"], {"waveforms": batch.numpy(), "weights": weights.numpy()})
+    return torch.from_numpy(embeddings)
+
+def compile_model():
+    """
+    Wraps the embedding network in torch.compile and warms it up on a dummy clip, so the
+    one-off compile cost is paid before the first real file rather than inside it.
+    """
+    print("Compiling the embedding model...")
+    get_model().model = compile_embedding_network(get_model().model)
+    dummy = np.random.default_rng(0).uniform(-0.1, 0.1, WARMUP_SECONDS * SAMPLE_RATE).astype(np.float32)
+    embed_waveform_batch([dummy])
+    print("Embedding model compiled.")
+
+def prepare_audio_file(audio_file_path: str):
+    """
+    Reads one file, looks its embedding up in the cache and, on a miss, decodes it.
+    Runs in a decode thread. Returns (cache_path, cached_embedding or None, waveform or None);
+    both are None for silent clips, which are not worth a forward pass.
+    """
+    print(f"Processing audio file: {audio_file_path}")
+    with open(audio_file_path, "rb") as f:
+        audio_data = f.read()
+    print(f"Received {len(audio_data)} bytes for processing from {audio_file_path}.")
+
+    cache_path = _embedding_cache_path(audio_data)
+    embedding = _load_cached_embedding(cache_path)
+    if embedding is not None:
+        return cache_path, embedding, None
+    waveform = decode_to_mono16k(audio_file_path)
+    if waveform.size == 0 or np.sqrt(np.mean(np.square(waveform))) < SILENCE_RMS_THRESHOLD:
+        print(f"{audio_file_path} is silent. Skipping inference.")
+        return cache_path, None, None
+    return cache_path, None, waveform
+
+def compute_similarities(target_speaker_embedding, audio_file_paths: list, prepared=None):
+    """
+    Computes the similarity of several audio files to the target speaker without waiting on the GPU.
+    Files without a cached embedding are embedded together in one forward pass, and all
+    similarities come out of a single matmul against the normalized target.
+    prepared may hold one prepare_audio_file() future per path, submitted ahead of time so
+    decoding overlaps earlier inference; otherwise the files are prepared here in parallel.
+    target_speaker_embedding is a unit-length (K, D) matrix of one or more target speakers.
+    Returns (similarities, new_cache_entries): a (len(audio_file_paths), K) tensor on the model
+    device with NaN rows for files that failed, and the (cache_path, embedding) pairs still to be
+    written with flush_cache_entries().
+    """
+    if prepared is None:
+        with ThreadPoolExecutor(max_workers=DECODE_WORKERS) as executor:
+            prepared = [executor.submit(prepare_audio_file, path) for path in audio_file_paths]
+
+    embeddings = [None] * len(audio_file_paths)
+    pending = [] # (index, cache_path, waveform) for cache misses
+    silent = []
+    for i, (audio_file_path, future) in enumerate(zip(audio_file_paths, prepared)):
+        try:
+            cache_path, embeddings[i], waveform = future.result()
+            if embeddings[i] is None and waveform is None:
+                silent.append(i)
+            elif embeddings[i] is None:
+                pending.append((i, cache_path, waveform))
+        except Exception as e:
+            print(f"Error processing audio file {audio_file_path}: {e}")
+
+    new_cache_entries = []
+    long_clips = [entry for entry in pending if len(entry[2]) > STREAM_MIN_SECONDS * SAMPLE_RATE]
+    pending = [entry for entry in pending if len(entry[2]) <= STREAM_MIN_SECONDS * SAMPLE_RATE]
+    for i, cache_path, waveform in long_clips:
+        try:
+            embeddings[i] = embed_long_waveform(waveform)
+            new_cache_entries.append((cache_path, embeddings[i]))
+        except Exception as e:
+            print(f"Error embedding long audio file {audio_file_paths[i]}: {e}")
+
+    if pending:
+        try:
+            batch_embeddings = embed_waveform_batch([waveform for _, _, waveform in pending])
+            for (i, cache_path, _), embedding in zip(pending, batch_embeddings):
+                embeddings[i] = embedding
+                new_cache_entries.append((cache_path, embedding))
+        except Exception as e:
+            print(f"Error embedding batch of {len(pending)} audio file(s): {e}")
+
+    similarities = torch.full((len(audio_file_paths), target_speaker_embedding.shape[0]), float("nan"), device=device)
+    similarities[silent] = 0.0
+    valid = [i for i, embedding in enumerate(embeddings) if embedding is not None]
+    if valid:
+        live_audio_embeddings = torch.stack([embeddings[i].reshape(-1).float() for i in valid])
+        similarities[valid] = _cosine_similarities(live_audio_embeddings, target_speaker_embedding)
+    return similarities, new_cache_entries
+
+if triton is not None:
+    @triton.jit
+    def _cosine_tail_kernel(embeddings_ptr, targets_ptr, out_ptr, D, K, BLOCK_D: tl.constexpr):
+        """One program per (row, target): loads the raw embedding row once, and returns its dot
+        product with the unit-length target divided by the row's L2 norm."""
+        row = tl.program_id(0)
+        target = tl.program_id(1)
+        offsets = tl.arange(0, BLOCK_D)
+        mask = offsets < D
+        x = tl.load(embeddings_ptr + row * D + offsets, mask=mask, other=0.0)
+        t = tl.load(targets_ptr + target * D + offsets, mask=mask, other=0.0)
+        norm = tl.sqrt(tl.sum(x * x, axis=0))
+        dot = tl.sum(x * t, axis=0)
+        # Same epsilon as torch.nn.functional.normalize
+        tl.store(out_ptr + row * K + target, dot / tl.maximum(norm, 1e-12))
+
+def _cosine_similarities(live_audio_embeddings: torch.Tensor, target_speaker_embedding: torch.Tensor) -> torch.Tensor:
+    """
+    Returns the (B, K) cosine similarities of raw (B, D) embeddings against unit-length (K, D) targets.
+    On CUDA with Triton installed, the normalize and the dot product run as a single fused kernel
+    that reads each embedding once; otherwise it is F.normalize followed by one matmul.
+    """
+    if triton is None or live_audio_embeddings.device.type != "cuda":
+        live_audio_embeddings = torch.nn.functional.normalize(live_audio_embeddings, p=2, dim=-1)
+        return live_audio_embeddings @ target_speaker_embedding.t()
+
+    live_audio_embeddings = live_audio_embeddings.contiguous()
+    num_rows, dim = live_audio_embeddings.shape
+    num_targets = target_speaker_embedding.shape[0]
+    out = torch.empty((num_rows, num_targets), dtype=torch.float32, device=live_audio_embeddings.device)
+    _cosine_tail_kernel[(num_rows, num_targets)](
+        live_audio_embeddings, target_speaker_embedding, out, dim, num_targets,
+        BLOCK_D=triton.next_power_of_2(dim)
+    )
+    return out
+
+def flush_cache_entries(new_cache_entries: list):
+    """Copies newly computed embeddings to the host in one transfer and writes them to the cache."""
+    if not new_cache_entries:
+        return
+    host_embeddings = torch.stack([embedding.reshape(-1) for _, embedding in new_cache_entries]).cpu()
+    for (cache_path, _), embedding in zip(new_cache_entries, host_embeddings):
+        _store_cached_embedding(cache_path, embedding)
+    _prune_embedding_cache()
+
+def similarities_to_results(similarities: torch.Tensor, audio_file_paths: list) -> list:
+    """
+    Syncs the (N, K) similarity matrix to the host once and returns one
+    (is_target, similarity, best_target_index) triple per path, scored against the closest target.
+    """
+    best_scores, best_targets = similarities.max(dim=-1)
+    best_scores, best_targets = best_scores.cpu(), best_targets.cpu().tolist()
+    is_target_flags = (best_scores > THRESHOLD).tolist()
+    scores = torch.nan_to_num(best_scores, nan=0.0).tolist()
+    for audio_file_path, is_target, similarity in zip(audio_file_paths, is_target_flags, scores):
+        print(f"Similarity for {audio_file_path}: {similarity:.4f}, Is Target: {is_target}")
+    return list(zip(is_target_flags, scores, best_targets))
+
+def calculate_similarities(target_speaker_embedding, audio_file_paths: list, prepared=None) -> list:
+    """
+    Calculates the similarity of several audio files to the target speaker(s).
+    Returns one (is_target, similarity) pair per path, using the closest target, and
+    (False, 0.0) for files that failed.
+    """
+    if target_speaker_embedding is None:
+        print("Target speaker embedding not loaded. Cannot perform detection.")
+        return [(False, 0.0)] * len(audio_file_paths)
+
+    similarities, new_cache_entries = compute_similarities(target_speaker_embedding, audio_file_paths, prepared)
+    flush_cache_entries(new_cache_entries)
+    return [(is_target, similarity) for is_target, similarity, _ in similarities_to_results(similarities, audio_file_paths)]
+
+def calculate_similarity(target_speaker_embedding, audio_file_path: str) -> tuple[bool, float]:
+    """Calculates the similarity of a single audio file to the target speaker."""
+    return calculate_similarities(target_speaker_embedding, [audio_file_path])[0]
+
+def _file_size(path: str) -> int:
+    """Returns the file size in bytes, or 0 if it cannot be read (the error is reported when the file is decoded)."""
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def analyze_files(target_speaker_embedding, audio_file_paths: list, batch_size: int = BATCH_SIZE) -> list:
+    """
+    Scores many audio files against the target speaker(s) in batches of batch_size.
+    The next batch is decoded while the current one is on the model, and similarities stay on
+    the device until every batch is queued, so the whole run syncs with the GPU once.
+    Returns one (is_target, similarity, best_target_index) triple per path, in input order.
+    """
+    if not audio_file_paths:
+        return []
+
+    # Group files of similar length into the same batch to keep padding small
+    order = sorted(range(len(audio_file_paths)), key=lambda i: _file_size(audio_file_paths[i]))
+    ordered_paths = [audio_file_paths[i] for i in order]
+    batches = [ordered_paths[start:start + batch_size] for start in range(0, len(ordered_paths), batch_size)]
+
+    batch_similarities = []
+    new_cache_entries = []
+    with ThreadPoolExecutor(max_workers=DECODE_WORKERS) as executor:
+        # At most two batches are held in memory
+        next_prepared = [executor.submit(prepare_audio_file, path) for path in batches[0]]
+        for batch_index, batch_files in enumerate(batches):
+            prepared = next_prepared
+            if batch_index + 1 < len(batches):
+                next_prepared = [executor.submit(prepare_audio_file, path) for path in batches[batch_index + 1]]
+            similarities, batch_cache_entries = compute_similarities(target_speaker_embedding, batch_files, prepared)
+            # Similarities stay on the device so the GPU queue never drains between batches
+            batch_similarities.append(similarities)
+            new_cache_entries.extend(batch_cache_entries)
+
+    flush_cache_entries(new_cache_entries)
+    results = [None] * len(audio_file_paths)
+    for i, result in zip(order, similarities_to_results(torch.cat(batch_similarities), ordered_paths)):
+        results[i] = result
+    return results
+
+def setup_acceleration(batch_size: int, use_compile=False, use_cuda_graph=False, use_onnx=True):
+    """Applies the optional model speedups selected on the command line."""
+    if use_onnx and not use_compile:
+        setup_onnx_runtime()
+    if use_compile:
+        compile_model()
+    if use_cuda_graph:
+        capture_cuda_graph(batch_size, CUDA_GRAPH_SECONDS)
+
+def query_server(socket_path: str, audio_file_paths: list):
+    """
+    Sends the file paths to a running similarity_server.py and returns (results, target_names),
+    with results in the same (is_target, similarity, best_target_index) form as analyze_files().
+    """
+    request = {"paths": [os.path.abspath(path) for path in audio_file_paths]}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        with client.makefile("rwb") as stream:
+            stream.write(json.dumps(request).encode("utf-8") + b"\n")
+            stream.flush()
+            response = json.loads(stream.readline())
+    if "error" in response:
+        raise RuntimeError(response["error"])
+    return [tuple(result) for result in response["results"]], response["targets"]
+
+def print_results(audio_file_paths: list, results: list, target_names: list):
+    """Prints the per-file analysis report."""
+    for audio_file, (is_target, similarity_score, best_target) in zip(audio_file_paths, results):
+        print(f"Analysis Result for {os.path.basename(audio_file)}:")
+        print(f"  Is Target Speaker: {is_target}")
+        print(f"  Similarity Score: {similarity_score:.4f}")
+        if len(target_names) > 1:
+            print(f"  Closest Target: {target_names[best_target]}")
+        print("-" * 30)
+
+def add_model_arguments(parser: argparse.ArgumentParser):
+    """Adds the target speaker and model options shared by this script and similarity_server.py."""
+    parser.add_argument("--target_speaker", type=str, nargs="+", default=[TARGET_SPEAKER_MP3],
+                        help=f"Path(s) to one or more target speaker MP3 files; each file is scored against the closest one (default: {TARGET_SPEAKER_MP3}).")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                        help=f"Number of files embedded per forward pass (default: {BATCH_SIZE}).")
+    add_compile_argument(parser)
+    parser.add_argument("--cuda-graph", action="store_true",
+                        help=f"Replay the model as a CUDA graph padded to {CUDA_GRAPH_SECONDS}s clips. Longer clips still run eagerly.")
+    parser.add_argument("--no-onnx", action="store_true",
+                        help="On CPU, run the embedding model with PyTorch instead of ONNX Runtime.")
+
+def load_model_and_targets(parser: argparse.ArgumentParser, args):
+    """Loads the model with the selected speedups and the target speaker(s). Exits if a target cannot be loaded."""
+    if args.compile and args.cuda_graph:
+        parser.error("--compile and --cuda-graph cannot be combined.")
+    print(f"Using device: {device}")
+    setup_acceleration(args.batch_size, args.compile, args.cuda_graph, not args.no_onnx)
 
     # Suppress specific UserWarning from torchaudio if it's not relevant to your use case
     with warnings.catch_warnings():
         warnings.simplefilter("ignore", UserWarning)
-        load_target_speaker_embedding(args.target_speaker)
+        load_target_speaker_embeddings(args.target_speaker)
 
     if target_speaker_embedding is None:
         print("\nCould not perform analysis as target speaker embedding was not loaded. Exiting.")
         exit(1)
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calculate audio similarity to a target speaker.")
+    parser.add_argument("--input_path", type=str, required=True,
+                        help="Path to an audio file (e.g., .webm, .mp3) or a directory containing audio files to analyze.")
+    add_model_arguments(parser)
+    parser.add_argument("--server", type=str, nargs="?", const=SERVER_SOCKET_PATH,
+                        help=f"Send the files to a running similarity_server.py instead of loading the model here (default socket: {SERVER_SOCKET_PATH}). The server's target speakers are used.")
+    args = parser.parse_args()
+
     audio_files_to_process = []
     if os.path.isfile(args.input_path):
         audio_files_to_process.append(args.input_path)
     elif os.path.isdir(args.input_path):
         print(f"Searching for audio files in directory: {args.input_path}")
-        for root, _, files in os.walk(args.input_path):
-            for file in files:
-                # Add more audio extensions if needed
-                if file.lower().endswith((".mp3", ".wav", ".flac", ".ogg", ".webm")):
-                    audio_files_to_process.append(os.path.join(root, file))
+        audio_files_to_process.extend(find_audio_files(args.input_path, AUDIO_EXTENSIONS))
         if not audio_files_to_process:
             print(f"No supported audio files found in {args.input_path} or its subdirectories.")
             exit(0)
@@ -151,13 +757,17 @@ if __name__ == "__main__":
         print(f"Error: Provided input_path '{args.input_path}' is neither a file nor a directory.")
         exit(1)
 
-    print(f"\n--- Starting Analysis for {len(audio_files_to_process)} Audio File(s) ---")
-    for audio_file in audio_files_to_process:
-        print(f"\nAnalyzing: {audio_file}")
-        is_target, similarity_score = calculate_similarity(target_speaker_embedding, audio_file)
-        print(f"Analysis Result for {os.path.basename(audio_file)}:")
-        print(f"  Is Target Speaker: {is_target}")
-        print(f"  Similarity Score: {similarity_score:.4f}")
-        print("-" * 30)
+    if args.server:
+        try:
+            results, target_names = query_server(args.server, audio_files_to_process)
+        except (OSError, RuntimeError, ValueError) as e:
+            print(f"Error querying similarity server at {args.server}: {e}")
+            exit(1)
+    else:
+        load_model_and_targets(parser, args)
+        print(f"\n--- Starting Analysis for {len(audio_files_to_process)} Audio File(s) ---")
+        results = analyze_files(target_speaker_embedding, audio_files_to_process, args.batch_size)
+        target_names = [os.path.basename(path) for path in args.target_speaker]
 
-    print("\n--- Analysis Complete ---")
\ No newline at end of file
+    print_results(audio_files_to_process, results, target_names)
+    print("\n--- Analysis Complete ---")
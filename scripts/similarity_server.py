@@ -0,0 +1,100 @@
+"""
+Keeps the pyannote/embedding model and the target speaker embedding(s) resident and scores
+audio files sent over a Unix socket, so repeated `similarity.py --server` runs skip the
+multi-second model load.
+
+Protocol: one JSON line per request, {"paths": ["/abs/path.mp3", ...]}, answered with one JSON
+line {"results": [[is_target, similarity, best_target_index], ...], "targets": [name, ...]}
+or {"error": "..."}.
+"""
+import os
+import stat
+import json
+import socket
+import argparse
+import socketserver
+
+import similarity
+
+
+class SimilarityRequestHandler(socketserver.StreamRequestHandler):
+    """Handles one client connection: reads a request line and writes back a response line."""
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            paths = request["paths"]
+            results = similarity.analyze_files(similarity.target_speaker_embedding, paths, self.server.batch_size)
+            response = {"results": results, "targets": self.server.target_names}
+        except Exception as e:
+            print(f"Error handling request: {e}")
+            response = {"error": str(e)}
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+class SimilarityServer(socketserver.UnixStreamServer):
+    """
+    Serves requests one at a time: the model is a single GPU-resident instance, and
+    analyze_files() already overlaps decoding with inference within a request.
+    """
+
+    def __init__(self, socket_path, batch_size, target_names):
+        self.batch_size = batch_size
+        self.target_names = target_names
+        super().__init__(socket_path, SimilarityRequestHandler)
+
+
+def prepare_socket_path(parser, socket_path):
+    """
+    Makes socket_path ready to bind, exiting via parser.error if it is unsafe: its directory
+    must belong to this user, and an existing path is removed only if it is a socket that no
+    running server answers on.
+    """
+    socket_dir = os.path.dirname(socket_path)
+    if socket_dir:
+        os.makedirs(socket_dir, mode=0o700, exist_ok=True)
+        if os.stat(socket_dir).st_uid != os.getuid():
+            parser.error(f"{socket_dir} is owned by another user; refusing to listen there.")
+    if not os.path.lexists(socket_path):
+        return
+    if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+        parser.error(f"{socket_path} exists and is not a socket; refusing to remove it.")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(socket_path)
+        except OSError:
+            pass # Nobody is listening: left behind by a server that did not shut down cleanly
+        else:
+            parser.error(f"Another server is already listening on {socket_path}.")
+    os.remove(socket_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve target speaker similarity over a Unix socket.")
+    parser.add_argument("--socket", type=str, default=similarity.SERVER_SOCKET_PATH,
+                        help=f"Unix socket path to listen on (default: {similarity.SERVER_SOCKET_PATH}).")
+    similarity.add_model_arguments(parser)
+    args = parser.parse_args()
+
+    # Check the socket path before the multi-second model load so a bad --socket fails fast
+    prepare_socket_path(parser, args.socket)
+    similarity.load_model_and_targets(parser, args)
+    similarity.get_model() # Targets may have come from disk; load the model now rather than on the first request
+
+    target_names = [os.path.basename(path) for path in args.target_speaker]
+    # Clients can make the server read any file it can access, so only this user may connect:
+    # bind with a umask that leaves the socket owner-only from the start, then chmod to be explicit.
+    old_umask = os.umask(0o177)
+    try:
+        server = SimilarityServer(args.socket, args.batch_size, target_names)
+    finally:
+        os.umask(old_umask)
+    os.chmod(args.socket, 0o600)
+    with server:
+        print(f"Similarity server listening on {args.socket}. Press Ctrl+C to stop.")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print("\nShutting down.")
+        finally:
+            os.remove(args.socket)